@@ -0,0 +1,189 @@
+# Measures building SVG of a dense code slide with the Xml builder and
+# with the previous, uncached escaping and serialisation; run as
+# python benchmarks/xml_builder.py
+
+import contextlib
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from elphie.slides import Slides, SlideBuilder, Context  # noqa
+from elphie.svg import RendererSVG  # noqa
+from elphie.sxml import Xml, escape_text  # noqa
+from elphie import svg  # noqa
+
+CODE = """
+def render_text(xml, x, y, parsed_text, style, styles, id=None):
+    xml.element("text")
+    if id is not None:
+        xml.set("id", id)
+    xml.set("x", x)
+    xml.set("y", y)
+    line_size = style.size * style.line_spacing
+    active_styles = [style]
+    for token_type, value in parsed_text:
+        if token_type == "text":
+            xml.text(value)
+        elif token_type == "newline":
+            for s in active_styles:
+                xml.close()  # tspan
+        elif token_type == "begin":
+            active_styles.append(styles[value])
+        elif token_type == "end":
+            active_styles.pop()
+        else:
+            raise Exception("Invalid token: '{}'".format(token_type))
+    return {"size": line_size, "styles": len(active_styles)}
+"""
+
+
+class ReferenceXml(Xml):
+
+    # Xml before attribute values and texts were escaped through caches
+
+    def element(self, name):
+        self._close()
+        self.chunks.append("<")
+        self.chunks.append(name)
+        self.stack.append(name)
+        self.is_open = True
+
+    def set(self, name, value):
+        assert self.is_open
+        value = str(value).replace("'", "\\'")
+        self.chunks.append(" {}='{}'".format(name, escape_text(value)))
+
+    def text(self, text):
+        self._close()
+        text = escape_text(str(text))
+        text = text.replace(" ", "&#160;")
+        self.chunks.append(text)
+
+    def close(self, text=None):
+        assert self.stack, "At least one element has to be opened"
+        assert text is None or self.stack[-1] == text
+        if self.is_open:
+            self.is_open = False
+            self.stack.pop()
+            self.chunks.append(" />")
+        else:
+            self.chunks.append("</")
+            self.chunks.append(self.stack.pop())
+            self.chunks.append(">")
+
+
+def reference_set_font_from_style(xml, style):
+    if style.font:
+        xml.set("font-family", style.font)
+    if style.size:
+        xml.set("font-size", style.size)
+    s = ""
+    if style.color:
+        s += "fill:{};".format(style.color)
+    if style.bold:
+        s += "font-weight: bold;"
+    if style.italic:
+        s += "font-style: italic;"
+    if s:
+        xml.set("style", s)
+
+
+def reference_render_text(xml, x, y, parsed_text, style, styles, id=None):
+    xml.element("text")
+    if id is not None:
+        xml.set("id", id)
+    xml.set("x", x)
+    xml.set("y", y)
+    if style.align == "center":
+        xml.set("text-anchor", "middle")
+    elif style.align == "right":
+        xml.set("text-anchor", "end")
+    elif style.align == "left":
+        xml.set("text-anchor", "left")
+    reference_set_font_from_style(xml, style)
+    line_size = style.size * style.line_spacing
+    active_styles = [style]
+    xml.element("tspan")
+    for token_type, value in parsed_text:
+        if token_type == "text":
+            xml.text(value)
+        elif token_type == "newline":
+            for s in active_styles:
+                xml.close()  # tspan
+            for i, s in enumerate(active_styles):
+                xml.element("tspan")
+                xml.set("xml:space", "preserve")
+                if i == 0:
+                    xml.set("x", x)
+                    xml.set("dy", line_size * value)
+                reference_set_font_from_style(xml, s)
+        elif token_type == "begin":
+            s = styles[value]
+            active_styles.append(s)
+            xml.element("tspan")
+            xml.set("xml:space", "preserve")
+            reference_set_font_from_style(xml, s)
+        elif token_type == "end":
+            xml.close()
+            active_styles.pop()
+        else:
+            raise Exception("Invalid token")
+    for s in active_styles:
+        xml.close()  # tspan
+    xml.close("text")  # text
+
+
+@contextlib.contextmanager
+def reference_builder():
+    xml_class = svg.Xml
+    render_text = svg.render_text
+    svg.Xml = ReferenceXml
+    svg.render_text = reference_render_text
+    try:
+        yield
+    finally:
+        svg.Xml = xml_class
+        svg.render_text = render_text
+
+
+def make_builder():
+    slides = Slides("benchmark.pdf", parse_args=False)
+    code = slides.new_slide("Code").code(CODE, "python")
+    code.consecutive_line_emphasis()
+    renderer = RendererSVG()
+    query_cache = {}
+    for slide in slides.slides:
+        ctx = Context(renderer, slide.theme, slide, None, None, {})
+        for key, query in slide.gather_queries(ctx):
+            query_cache[key] = (600, query.get_height())
+    return SlideBuilder(slides.slides, slides.width, slides.height, {},
+                        query_cache)
+
+
+def measure(builder, steps, repeat=20):
+    # build_steps releases the layout of the slide, so every run lays
+    # it out again; both variants pay for that equally
+    best = min(timeit.repeat(lambda: builder.build_steps(0, steps),
+                             number=repeat, repeat=5))
+    return best * 1000 / repeat / len(steps)
+
+
+def main():
+    builder = make_builder()
+    slide = builder.slides[0]
+    steps = range(1, slide.get_max_step() + 1)
+    # The first run also fills the caches of the Xml builder
+    output = builder.build_steps(0, steps)
+    current = measure(builder, steps)
+    with reference_builder():
+        assert builder.build_steps(0, steps) == output
+        reference = measure(builder, steps)
+    print("{} steps: {:.2f} ms per step, {:.2f} ms before caching "
+          "({:.2f}x)".format(len(steps), current, reference,
+                             reference / current))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,764 @@
+import abc
+import fcntl
+import json
+import os
+import pickle
+import sqlite3
+import struct
+import threading
+import time
+
+
+QUERY_CACHE_VERSION = 2
+QUERY_CACHE_HEADER = b"ELPHIEQC" + struct.pack(">H", QUERY_CACHE_VERSION)
+
+RECORD_HEADER = struct.Struct(">I")
+
+# The file is rewritten when less than a half of its records is live
+COMPACT_MIN_RECORDS = 256
+COMPACT_RATIO = 2
+
+
+class QueryCache:
+
+    # Append-only log of pickled batches of (key, value) pairs.
+    # A record that was not completely written (e.g. after a crash)
+    # is dropped together with everything behind it.
+    #
+    # The file may be shared by several processes. Writers hold
+    # an exclusive lock on '<filename>.lock' and first read records
+    # appended by others; a compacted file is replaced atomically,
+    # so readers never need the lock.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = None
+        self.records = 0
+        self.valid_size = 0
+        self.file = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        self.entries = {}
+        self.records = 0
+        self.valid_size = 0
+        try:
+            with open(self.filename, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        self._parse(data, 0)
+
+    def _parse(self, data, offset):
+        # Parses records from data that starts at the offset in the file
+        position = 0
+        if offset == 0:
+            if not data.startswith(QUERY_CACHE_HEADER):
+                return  # Unknown format or an old version
+            position = len(QUERY_CACHE_HEADER)
+        entries = self.entries
+        while position + RECORD_HEADER.size <= len(data):
+            size = RECORD_HEADER.unpack_from(data, position)[0]
+            start = position + RECORD_HEADER.size
+            if start + size > len(data):
+                break
+            try:
+                items = pickle.loads(data[start:start + size])
+            except Exception:
+                break
+            entries.update(items)
+            self.records += len(items)
+            position = start + size
+        self.valid_size = offset + position
+
+    def _ensure_loaded(self):
+        if self.entries is None:
+            self._load()
+
+    def _sync(self):
+        # Called with the file lock held; makes the open file the current
+        # one and reads records written by other processes
+        if self.file is not None:
+            try:
+                replaced = os.stat(self.filename).st_ino != \
+                    os.fstat(self.file.fileno()).st_ino
+            except FileNotFoundError:
+                replaced = True
+            if replaced:
+                self._close()
+        if self.file is None:
+            fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666)
+            self.file = os.fdopen(fd, "r+b")
+            self.entries = {}
+            self.records = 0
+            self.valid_size = 0
+            data = self.file.read()
+        else:
+            self.file.seek(self.valid_size)
+            data = self.file.read()
+            if not data:
+                return
+        self._parse(data, self.valid_size)
+        if self.valid_size == 0:
+            self.file.seek(0)
+            self.file.write(QUERY_CACHE_HEADER)
+            self.valid_size = len(QUERY_CACHE_HEADER)
+        # Only a crashed writer leaves an incomplete record behind
+        self.file.truncate(self.valid_size)
+        self.file.seek(self.valid_size)
+
+    def _locked_file(self):
+        return FileLock(self.filename + ".lock")
+
+    def __len__(self):
+        with self.lock:
+            self._ensure_loaded()
+            return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            self._ensure_loaded()
+            return self.entries.get(key, default)
+
+    def items(self):
+        with self.lock:
+            self._ensure_loaded()
+            return list(self.entries.items())
+
+    def put_many(self, items):
+        items = list(items)
+        if not items:
+            return
+        data = pickle.dumps(items, pickle.HIGHEST_PROTOCOL)
+        with self.lock, self._locked_file():
+            self._sync()
+            self.entries.update(items)
+            self.records += len(items)
+            self.file.write(RECORD_HEADER.pack(len(data)))
+            self.file.write(data)
+            self.file.flush()
+            self.valid_size = self.file.tell()
+
+    def needs_compaction(self, live_keys=None):
+        # Without live keys, only records of overwritten keys are dropped
+        with self.lock:
+            self._ensure_loaded()
+            if live_keys is None:
+                live_keys = self.entries
+            return self.records >= COMPACT_MIN_RECORDS and \
+                self.records > COMPACT_RATIO * len(live_keys)
+
+    def compact(self, live_keys=None):
+        with self.lock, self._locked_file():
+            self._sync()
+            if live_keys is None:
+                live_keys = self.entries
+            entries = dict((key, self.entries[key])
+                           for key in live_keys if key in self.entries)
+            self._close()
+            tmp_filename = "{}.{}.tmp".format(self.filename, os.getpid())
+            with open(tmp_filename, "wb") as f:
+                f.write(QUERY_CACHE_HEADER)
+                data = pickle.dumps(list(entries.items()),
+                                    pickle.HIGHEST_PROTOCOL)
+                f.write(RECORD_HEADER.pack(len(data)))
+                f.write(data)
+                self.valid_size = f.tell()
+            os.replace(tmp_filename, self.filename)
+            self.entries = entries
+            self.records = len(entries)
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+
+class FileLock:
+
+    # flock() based lock of a file shared by processes
+
+    def __init__(self, filename, shared=False):
+        self.filename = filename
+        self.shared = shared
+        self.file = None
+
+    def acquire(self, blocking=True):
+        self.file = open(self.filename, "a")
+        flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.file, flags)
+        except BlockingIOError:
+            self.file.close()
+            self.file = None
+            return False
+        return True
+
+    def release(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class GarbagePolicy:
+
+    # What is kept in the cache:
+    # - blobs of the last 'generations' builds of each deck,
+    # - only decks built and blobs used in the last 'max_age' seconds,
+    # - at most 'max_size' bytes; least recently used blobs go first,
+    #   blobs of the newest build of a deck go last
+
+    def __init__(self, generations=1, max_size=None, max_age=None):
+        self.generations = generations
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def select(self, manifest, now):
+        # Returns (retained generations of each deck, removed blobs)
+        retained = {}
+        newest = set()
+        referenced = set()
+        for deck, generations in manifest.decks.items():
+            generations = sorted(generations, reverse=True)
+            generations = generations[:max(1, self.generations)]
+            if self.max_age is not None:
+                generations = [g for g in generations
+                               if g[1] >= now - self.max_age]
+            if not generations:
+                continue
+            retained[deck] = set(g[0] for g in generations)
+            newest.update(generations[0][2])
+            for generation in generations:
+                referenced.update(generation[2])
+
+        removed = []
+        kept = []
+        for name, (size, last_used) in manifest.blobs.items():
+            if name not in referenced or (self.max_age is not None and
+                                          last_used < now - self.max_age):
+                removed.append(name)
+            else:
+                kept.append((name in newest, last_used, name, size))
+
+        if self.max_size is not None:
+            kept.sort()
+            total = sum(item[3] for item in kept)
+            for is_newest, last_used, name, size in kept:
+                if total <= self.max_size:
+                    break
+                removed.append(name)
+                total -= size
+        return retained, sorted(removed)
+
+
+class CacheManifest:
+
+    # blobs: name -> (size, last used time)
+    # decks: deck -> list of (generation, time, names of blobs)
+
+    def __init__(self, blobs, decks):
+        self.blobs = blobs
+        self.decks = decks
+
+    def get_referenced_blobs(self):
+        return set(name
+                   for generations in self.decks.values()
+                   for generation, build_time, names in generations
+                   for name in names)
+
+    def get_report(self):
+        lines = []
+        owners = {}
+        for deck, generations in self.decks.items():
+            for generation, build_time, names in generations:
+                for name in names:
+                    owners.setdefault(name, set()).add(deck)
+        total = sum(size for size, last_used in self.blobs.values())
+        lines.append("Cache: {} blobs, {}".format(
+            len(self.blobs), format_size(total)))
+        for deck in sorted(self.decks):
+            generations = sorted(self.decks[deck], reverse=True)
+            names = set(name for g in generations for name in g[2]
+                        if name in self.blobs)
+            latest = set(name for name in generations[0][2]
+                         if name in self.blobs)
+            own = [name for name in names if owners[name] == set((deck,))]
+            lines.append(
+                "  {}: {} generation(s), last built {}; latest {} in {} "
+                "blob(s), all {}, only this deck {}".format(
+                    deck,
+                    len(generations),
+                    time.strftime("%Y-%m-%d %H:%M",
+                                  time.localtime(generations[0][1])),
+                    format_size(self._get_size(latest)),
+                    len(latest),
+                    format_size(self._get_size(names)),
+                    format_size(self._get_size(own))))
+        unreferenced = set(self.blobs) - set(owners)
+        lines.append("  Unreferenced: {} blob(s), {}".format(
+            len(unreferenced), format_size(self._get_size(unreferenced))))
+        return "\n".join(lines)
+
+    def _get_size(self, names):
+        return sum(self.blobs[name][0] for name in names)
+
+
+class CacheBackend(abc.ABC):
+
+    # Storage of measurements, fingerprints and built pages (blobs).
+    # Several decks may be built against one cache at once; a build
+    # holds a shared lock, each build of a deck records blobs that it
+    # uses as a new generation, and blobs are removed only under the
+    # exclusive lock, i.e. when no other build is running
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_filename = os.path.join(path, "lock")
+        self.build_lock = FileLock(self.lock_filename, shared=True)
+
+    def lock_build(self):
+        self.build_lock.acquire()
+
+    def unlock_build(self):
+        self.build_lock.release()
+
+    @abc.abstractmethod
+    def open_store(self, name):
+        # Returns a key-value store with the interface of QueryCache
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def has_blob(self, name):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def read_blob(self, name):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def write_blob(self, name, filename):
+        # Takes over a completely written file
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def record_build(self, deck, names, store_keys=None):
+        # 'store_keys' maps names of stores to keys used by the build
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def get_manifest(self):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def _prune(self, retained, removed):
+        raise NotImplementedError()
+
+    def _record_store_keys(self, deck, generation, store_keys):
+        # Kept in the store itself; keys of a store live as long as
+        # a generation that used them
+        for name, keys in (store_keys or {}).items():
+            store = self.open_store(name)
+            try:
+                store.put_many(((("build", deck, generation), list(keys)),))
+            finally:
+                store.close()
+
+    def _compact_stores(self, names, retained):
+        for name in names:
+            store = self.open_store(name)
+            try:
+                live_keys = set()
+                for key, value in store.items():
+                    if isinstance(key, tuple) and len(key) == 3 and \
+                            key[0] == "build" and \
+                            key[2] in retained.get(key[1], ()):
+                        live_keys.add(key)
+                        live_keys.update(value)
+                if store.needs_compaction(live_keys):
+                    store.compact(live_keys)
+            finally:
+                store.close()
+
+    def collect_garbage(self, policy=None, stores=()):
+        # Returns removed blobs or None when another build is running;
+        # 'stores' are compacted to keys recorded by retained builds
+        if policy is None:
+            policy = GarbagePolicy()
+        lock = FileLock(self.lock_filename)
+        if not lock.acquire(blocking=False):
+            return None
+        try:
+            # Temporary files are left only by interrupted builds
+            for name in os.listdir(self.path):
+                if name.endswith(".tmp"):
+                    os.remove(os.path.join(self.path, name))
+            retained, removed = policy.select(self.get_manifest(),
+                                              time.time())
+            self._prune(retained, removed)
+            self._compact_stores(stores, retained)
+            return removed
+        finally:
+            lock.release()
+
+    def close(self):
+        pass
+
+
+class DirectoryBackend(CacheBackend):
+
+    # Stores are QueryCache logs, blobs are files in the directory;
+    # generations of decks and sizes and use times of blobs are kept
+    # in 'manifest.json'
+
+    manifest_filename = "manifest.json"
+
+    def open_store(self, name):
+        return QueryCache(os.path.join(self.path, name))
+
+    def has_blob(self, name):
+        return os.path.isfile(os.path.join(self.path, name))
+
+    def read_blob(self, name):
+        with open(os.path.join(self.path, name), "rb") as f:
+            return f.read()
+
+    def write_blob(self, name, filename):
+        os.replace(filename, os.path.join(self.path, name))
+
+    def _lock_manifest(self):
+        return FileLock(os.path.join(self.path, "manifest.lock"))
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, self.manifest_filename)) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"blobs": {}, "decks": {}}
+        return data
+
+    def _write_manifest(self, data):
+        filename = os.path.join(self.path, self.manifest_filename)
+        tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmp_filename, "w") as f:
+            json.dump(data, f, sort_keys=True)
+        os.replace(tmp_filename, filename)
+
+    def record_build(self, deck, names, store_keys=None):
+        deck = os.path.abspath(deck)
+        now = time.time()
+        with self._lock_manifest():
+            data = self._read_manifest()
+            generations = data["decks"].setdefault(deck, [])
+            number = max((g[0] for g in generations), default=0) + 1
+            generations.append([number, now, sorted(set(names))])
+            for name in names:
+                try:
+                    size = os.path.getsize(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    continue
+                data["blobs"][name] = [size, now]
+            self._write_manifest(data)
+        self._record_store_keys(deck, number, store_keys)
+
+    def get_manifest(self):
+        data = self._read_manifest()
+        # Files are the source of truth for blobs (pages and images)
+        blobs = {}
+        for name in os.listdir(self.path):
+            if name.endswith((".pdf", ".png")):
+                entry = data["blobs"].get(name)
+                if entry is None:
+                    stat = os.stat(os.path.join(self.path, name))
+                    entry = (stat.st_size, stat.st_mtime)
+                blobs[name] = tuple(entry)
+        decks = dict((deck, [tuple(g) for g in generations])
+                     for deck, generations in data["decks"].items())
+        return CacheManifest(blobs, decks)
+
+    def _prune(self, retained, removed):
+        for name in removed:
+            os.remove(os.path.join(self.path, name))
+        with self._lock_manifest():
+            data = self._read_manifest()
+            data["decks"] = dict(
+                (deck, [g for g in generations if g[0] in retained[deck]])
+                for deck, generations in data["decks"].items()
+                if deck in retained)
+            for name in removed:
+                data["blobs"].pop(name, None)
+            self._write_manifest(data)
+
+
+class SQLiteBackend(CacheBackend):
+
+    # Everything in one SQLite database; keys are pickled with a fixed
+    # protocol, so equal keys are stored as equal bytes. Pages are
+    # written in chunks and read back whole, one page at a time
+
+    filename = "cache.sqlite"
+    key_protocol = 4
+    schema_version = 2
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(path, self.filename),
+            timeout=60,
+            isolation_level=None,
+            check_same_thread=False)
+        self.execute("PRAGMA journal_mode=WAL")
+        self.transaction(self._create_schema)
+
+    def _create_schema(self, connection):
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.schema_version:
+            # It is only a cache, an old one is dropped
+            for table in ("entries", "blobs", "refs", "generations"):
+                connection.execute("DROP TABLE IF EXISTS " + table)
+            connection.execute(
+                "PRAGMA user_version = {}".format(self.schema_version))
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                store TEXT NOT NULL,
+                key BLOB NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (store, key))""")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                name TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL)""")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS generations (
+                deck TEXT NOT NULL,
+                generation INTEGER NOT NULL,
+                time REAL NOT NULL,
+                PRIMARY KEY (deck, generation))""")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS refs (
+                deck TEXT NOT NULL,
+                generation INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                PRIMARY KEY (deck, generation, name))""")
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS refs_name ON refs (name)")
+
+    def execute(self, sql, args=()):
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def transaction(self, fn):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self.connection)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            return result
+
+    def open_store(self, name):
+        return SQLiteStore(self, name)
+
+    def has_blob(self, name):
+        return bool(self.execute(
+            "SELECT 1 FROM blobs WHERE name = ?", (name,)))
+
+    def read_blob(self, name):
+        rows = self.execute("SELECT data FROM blobs WHERE name = ?", (name,))
+        if not rows:
+            raise KeyError(name)
+        return rows[0][0]
+
+    def write_blob(self, name, filename):
+        size = os.path.getsize(filename)
+
+        def write(connection):
+            if not hasattr(connection, "blobopen"):
+                # Incremental blob I/O needs Python 3.11
+                with open(filename, "rb") as f:
+                    data = f.read()
+                connection.execute(
+                    "INSERT OR REPLACE INTO blobs (name, data, size, "
+                    "last_used) VALUES (?, ?, ?, ?)",
+                    (name, data, size, time.time()))
+                return
+            cursor = connection.execute(
+                "INSERT OR REPLACE INTO blobs (name, data, size, last_used) "
+                "VALUES (?, zeroblob(?), ?, ?)",
+                (name, size, size, time.time()))
+            with open(filename, "rb") as f, \
+                    connection.blobopen("blobs", "data",
+                                        cursor.lastrowid) as blob:
+                for chunk in iter(lambda: f.read(BLOB_CHUNK_SIZE), b""):
+                    blob.write(chunk)
+        self.transaction(write)
+        os.remove(filename)
+
+    def record_build(self, deck, names, store_keys=None):
+        deck = os.path.abspath(deck)
+        now = time.time()
+        names = sorted(set(names))
+
+        def record(connection):
+            number = connection.execute(
+                "SELECT COALESCE(MAX(generation), 0) + 1 FROM generations "
+                "WHERE deck = ?", (deck,)).fetchone()[0]
+            connection.execute(
+                "INSERT INTO generations (deck, generation, time) "
+                "VALUES (?, ?, ?)", (deck, number, now))
+            connection.executemany(
+                "INSERT INTO refs (deck, generation, name) VALUES (?, ?, ?)",
+                ((deck, number, name) for name in names))
+            connection.executemany(
+                "UPDATE blobs SET last_used = ? WHERE name = ?",
+                ((now, name) for name in names))
+            return number
+        number = self.transaction(record)
+        self._record_store_keys(deck, number, store_keys)
+
+    def get_manifest(self):
+        blobs = dict((name, (size, last_used))
+                     for name, size, last_used in self.execute(
+                         "SELECT name, size, last_used FROM blobs"))
+        names = {}
+        for deck, generation, name in self.execute(
+                "SELECT deck, generation, name FROM refs"):
+            names.setdefault((deck, generation), []).append(name)
+        decks = {}
+        for deck, generation, build_time in self.execute(
+                "SELECT deck, generation, time FROM generations"):
+            decks.setdefault(deck, []).append(
+                (generation, build_time,
+                 sorted(names.get((deck, generation), ()))))
+        return CacheManifest(blobs, decks)
+
+    def _prune(self, retained, removed):
+        def prune(connection):
+            old = [(deck, generation)
+                   for deck, generation in connection.execute(
+                       "SELECT deck, generation FROM generations")
+                   if generation not in retained.get(deck, ())]
+            for table in ("generations", "refs"):
+                connection.executemany(
+                    "DELETE FROM {} WHERE deck = ? AND generation = ?"
+                    .format(table), old)
+            connection.executemany("DELETE FROM blobs WHERE name = ?",
+                                   ((name,) for name in removed))
+        self.transaction(prune)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# Pages are copied into the database by chunks of this size
+BLOB_CHUNK_SIZE = 1 << 20
+
+
+class SQLiteStore:
+
+    # The interface of QueryCache over a table of SQLiteBackend
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def _dump_key(self, key):
+        return pickle.dumps(key, self.backend.key_protocol)
+
+    def get(self, key, default=None):
+        rows = self.backend.execute(
+            "SELECT value FROM entries WHERE store = ? AND key = ?",
+            (self.name, self._dump_key(key)))
+        if not rows:
+            return default
+        return pickle.loads(rows[0][0])
+
+    def __len__(self):
+        return self.backend.execute(
+            "SELECT COUNT(*) FROM entries WHERE store = ?", (self.name,))[0][0]
+
+    def items(self):
+        return [(pickle.loads(key), pickle.loads(value))
+                for key, value in self.backend.execute(
+                    "SELECT key, value FROM entries WHERE store = ?",
+                    (self.name,))]
+
+    def put_many(self, items):
+        rows = [(self.name, self._dump_key(key),
+                 pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                for key, value in items]
+        if not rows:
+            return
+        self.backend.transaction(lambda connection: connection.executemany(
+            "INSERT OR REPLACE INTO entries (store, key, value) "
+            "VALUES (?, ?, ?)", rows))
+
+    def needs_compaction(self, live_keys=None):
+        # Keys are unique in the table, so only dead keys can be dropped
+        if live_keys is None:
+            return False
+        records = len(self)
+        return records >= COMPACT_MIN_RECORDS and \
+            records > COMPACT_RATIO * len(live_keys)
+
+    def compact(self, live_keys=None):
+        if live_keys is None:
+            return
+        live = [(self._dump_key(key),) for key in live_keys]
+
+        def compact(connection):
+            connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS live (key BLOB PRIMARY KEY)")
+            connection.execute("DELETE FROM temp.live")
+            connection.executemany(
+                "INSERT OR IGNORE INTO temp.live (key) VALUES (?)", live)
+            connection.execute(
+                "DELETE FROM entries WHERE store = ? AND "
+                "key NOT IN (SELECT key FROM temp.live)", (self.name,))
+            connection.execute("DELETE FROM temp.live")
+        self.backend.transaction(compact)
+
+    def close(self):
+        pass
+
+
+CACHE_BACKENDS = {
+    "directory": DirectoryBackend,
+    "sqlite": SQLiteBackend,
+}
+
+
+def parse_size(text):
+    # '500M' -> 524288000
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    for unit in ("B", "K", "M"):
+        if size < 1024:
+            return "{:.1f}{}".format(size, unit) if unit != "B" \
+                else "{}B".format(size)
+        size /= 1024.0
+    return "{:.1f}G".format(size)
@@ -1,11 +1,8 @@
 
 from elphie.textparser import parse_text
-import lxml.etree as et
-import elphie.svg as svg
 from elphie.highlight import highlight_code
 from elphie.utils import SizeRequest
-
-from copy import deepcopy
+from elphie.imagestore import image_store
 
 
 def normalize_show(value):
@@ -33,15 +30,39 @@ class Element:
             return end
 
     def is_visible(self, ctx):
+        return self.is_visible_in_step(ctx.step)
+
+    def is_visible_in_step(self, step):
         start, end = normalize_show(self.show)
-        return start <= ctx.step and (end is None or ctx.step <= end)
+        return start <= step and (end is None or step <= end)
+
+    def get_step_state(self, step):
+        # Steps with equal states are rendered in the same way
+        if not self.is_visible_in_step(step):
+            return None
+        return tuple(child.get_step_state(step) for child in self.childs)
 
     def render(self, ctx, rect):
         if self.is_visible(ctx):
             ctx.push(self)
-            self.render_body(ctx, rect)
+            if self in ctx.layout.invariant_elements:
+                self._render_fragment(ctx, rect)
+            else:
+                self.render_body(ctx, rect)
             ctx.pop()
 
+    def _render_fragment(self, ctx, rect):
+        # The output is the same in all steps, it is generated only once
+        key = (rect.x, rect.y, rect.width, rect.height) + tuple(ctx.stack)
+        fragment = ctx.layout.fragments.get(key)
+        if fragment is None:
+            mark = ctx.renderer.begin_fragment()
+            self.render_body(ctx, rect)
+            fragment = ctx.renderer.end_fragment(mark)
+            ctx.layout.fragments[key] = fragment
+        else:
+            ctx.renderer.draw_fragment(fragment)
+
     def gather_queries(self, ctx, queries):
         ctx.push(self)
         self._gather_queries(ctx, queries)
@@ -69,6 +90,13 @@ class TextBase(Element):
             ends.append(end)
         return max(ends)
 
+    def get_step_state(self, step):
+        if not self.is_visible_in_step(step):
+            return None
+        return tuple(i for i, (line_numbers, (s, e), color)
+                     in enumerate(self.emphasis)
+                     if s <= step and (e is None or step <= e))
+
     def consecutive_line_emphasis(
             self, start=1, predicate_fn=None, color=None):
         step = start
@@ -249,76 +277,50 @@ class Box(Element):
         ctx.theme.render_box(ctx, rect, self)
 
 
-def _parse_label(element):
-    label = element.get("{http://www.inkscape.org/namespaces/inkscape}label")
-    if label is None:
-        return None
-    pos = label.find("**")
-    if pos == -1:
-        return None
-    label = label[pos + 2:].strip()
-    if label.isdigit():
-        return int(label), None
-    parts = label.split("-")
-    if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
-        return int(parts[0]), int(parts[1])
-    return None
-
-
 class Image(Element):
 
     def __init__(self, filename, scale, show):
+        super().__init__(show)
         self.filename = filename
-        self.root = et.parse(filename).getroot()
         self.scale = scale
-        self.width = svg.string_to_pixels(self.root.get("width"))
-        self.height = svg.string_to_pixels(self.root.get("height"))
-        if scale is not None:
-            self.width *= scale
-            self.height *= scale
-
-        global_start, global_end = normalize_show(show)
-        inner_max_step = 1
-        for element in self.root.iter():
-            value = _parse_label(element)
-            if value is None:
-                continue
-            start, max_step = value
-            if max_step is None and start >= inner_max_step:
-                inner_max_step = start
-            if max_step is not None and max_step >= inner_max_step:
-                inner_max_step = max_step
-
-        self.max_step = inner_max_step + global_start - 1
-        self.has_inner_steps = inner_max_step > 1
-        self.start_step = global_start
-        super().__init__(show)
+        self.start_step = normalize_show(show)[0]
+        self._data = None
+
+    @property
+    def data(self):
+        # Parsing and measuring are postponed until they are needed
+        if self._data is None:
+            self._data = image_store.get(self.filename)
+        return self._data
+
+    @property
+    def width(self):
+        if self.scale is not None:
+            return self.data.width * self.scale
+        return self.data.width
+
+    @property
+    def height(self):
+        if self.scale is not None:
+            return self.data.height * self.scale
+        return self.data.height
+
+    def get_fingerprint_state(self):
+        state = dict((name, value) for name, value in self.__dict__.items()
+                     if not name.startswith("_"))
+        state["file"] = self.data.key[1:]
+        return state
 
     def get_max_step(self):
-        return self.max_step
+        return self.data.max_step + self.start_step - 1
+
+    def get_step_state(self, step):
+        if not self.is_visible_in_step(step):
+            return None
+        return self.data.get_inner_state(step - self.start_step + 1)
 
     def get_data(self, step):
-        hidden = []
-
-        def find_hidden_elements(element):
-            for child in element:
-                value = _parse_label(child)
-                if value is not None:
-                    start, end = value
-                    if step < start or (end is not None and step > end):
-                        hidden.append((element, child))
-                        continue
-                find_hidden_elements(child)
-
-        if not self.has_inner_steps:
-            return et.tostring(self.root).decode()
-
-        step -= self.start_step - 1
-        root = deepcopy(self.root)
-        find_hidden_elements(root)
-        for element, child in hidden:
-            element.remove(child)
-        return et.tostring(root).decode()
+        return self.data.get_variant(step - self.start_step + 1)
 
     def get_size_request(self, ctx):
         return ctx.theme.get_image_size_request(ctx, self)
@@ -0,0 +1,95 @@
+
+import hashlib
+import types
+
+# Increase when a change of Elphie changes how slides look
+FINGERPRINT_VERSION = 1
+
+
+def update_fingerprint(h, value):
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        h.update(repr(value).encode())
+        h.update(b";")
+    elif isinstance(value, (list, tuple)):
+        h.update(b"[")
+        for item in value:
+            update_fingerprint(h, item)
+        h.update(b"]")
+    elif isinstance(value, dict):
+        h.update(b"{")
+        for key in sorted(value, key=repr):
+            update_fingerprint(h, key)
+            update_fingerprint(h, value[key])
+        h.update(b"}")
+    elif isinstance(value, (set, frozenset)):
+        # Items are ordered by their own fingerprints
+        h.update(b"(")
+        for item in sorted(make_fingerprint(item) for item in value):
+            h.update(item.encode())
+        h.update(b")")
+    else:
+        get_state = getattr(value, "get_fingerprint_state", None)
+        if get_state is not None:
+            state = get_state()
+        elif hasattr(value, "__dict__"):
+            state = dict((name, v) for name, v in vars(value).items()
+                         if not name.startswith("_"))
+        else:
+            raise Exception(
+                "Value of type '{}' cannot be fingerprinted; define "
+                "get_fingerprint_state() for it".format(
+                    type(value).__qualname__))
+        h.update(type(value).__qualname__.encode())
+        h.update(get_class_code_fingerprint(type(value)).encode())
+        update_fingerprint(h, state)
+
+
+_class_code_fingerprints = {}
+
+
+def get_class_code_fingerprint(cls):
+    # Methods of classes defined outside of Elphie (e.g. a theme of
+    # the user), so their change rebuilds slides; changes of Elphie are
+    # covered by FINGERPRINT_VERSION
+    result = _class_code_fingerprints.get(cls)
+    if result is None:
+        h = hashlib.sha1()
+        for klass in cls.__mro__:
+            module = klass.__module__.split(".")[0]
+            if module in ("elphie", "builtins"):
+                continue
+            for name, value in sorted(vars(klass).items()):
+                if isinstance(value, (staticmethod, classmethod)):
+                    value = value.__func__
+                elif isinstance(value, property):
+                    value = value.fget
+                code = getattr(value, "__code__", None)
+                if isinstance(code, types.CodeType):
+                    h.update(name.encode())
+                    _update_code(h, code)
+        result = h.hexdigest() if h.digest() != _EMPTY_DIGEST else ""
+        _class_code_fingerprints[cls] = result
+    return result
+
+
+_EMPTY_DIGEST = hashlib.sha1().digest()
+
+
+def _update_code(h, code):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _update_code(h, const)
+        elif isinstance(const, frozenset):
+            h.update(repr(sorted(const, key=repr)).encode())
+        else:
+            h.update(repr(const).encode())
+
+
+def make_fingerprint(*values):
+    h = hashlib.sha1()
+    update_fingerprint(h, FINGERPRINT_VERSION)
+    for value in values:
+        update_fingerprint(h, value)
+    return h.hexdigest()
@@ -0,0 +1,362 @@
+
+import os
+import struct
+import threading
+
+
+FONT_DIRS = ("/usr/share/fonts",
+             "/usr/local/share/fonts",
+             "~/.fonts",
+             "~/.local/share/fonts")
+
+FONT_EXTENSIONS = (".ttf", ".otf")
+
+
+class FontFormatError(Exception):
+    pass
+
+
+class Font:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = None
+        self.tables = None
+        self.cmap = None
+        self.advances = None
+        self.extents = None
+
+        # Only the directory and a few small tables are read for indexing,
+        # the whole file is loaded with metrics
+        with open(filename, "rb") as f:
+            self._read_directory(f)
+            head = self._read_table(f, "head")
+            name = self._read_table(f, "name")
+            os2 = self._read_table(f, "OS/2") \
+                if "OS/2" in self.tables else None
+        self.units_per_em = struct.unpack_from(">H", head, 18)[0]
+        mac_style = struct.unpack_from(">H", head, 44)[0]
+        self.bold = bool(mac_style & 1)
+        self.italic = bool(mac_style & 2)
+        if os2 is not None:
+            weight = struct.unpack_from(">H", os2, 4)[0]
+            selection = struct.unpack_from(">H", os2, 62)[0]
+            self.bold = self.bold or weight >= 600
+            self.italic = self.italic or bool(selection & 1)
+        self.family = _read_name(name, (16, 1))
+
+    def _read_directory(self, f):
+        header = f.read(12)
+        if len(header) < 12:
+            raise FontFormatError("File is too short")
+        version, count = struct.unpack_from(">IH", header, 0)
+        if version not in (0x00010000, 0x4f54544f, 0x74727565):
+            raise FontFormatError("Unsupported font format")
+        directory = f.read(count * 16)
+        if len(directory) < count * 16:
+            raise FontFormatError("File is too short")
+        tables = {}
+        for i in range(count):
+            tag, checksum, offset, length = \
+                struct.unpack_from(">4sIII", directory, i * 16)
+            tables[tag.decode("latin-1")] = (offset, length)
+        for tag in ("head", "hhea", "hmtx", "cmap", "name"):
+            if tag not in tables:
+                raise FontFormatError("Missing table '{}'".format(tag))
+        self.tables = tables
+
+    def _read_table(self, f, tag):
+        offset, length = self.tables[tag]
+        f.seek(offset)
+        data = f.read(length)
+        if len(data) < length:
+            raise FontFormatError("Table '{}' is truncated".format(tag))
+        return data
+
+    def _read(self):
+        if self.data is None:
+            with open(self.filename, "rb") as f:
+                self.data = f.read()
+        return self.data
+
+    def _table(self, tag):
+        return self.tables[tag][0]
+
+    def _load_metrics(self):
+        data = self._read()
+        number_of_metrics = struct.unpack_from(
+            ">H", data, self._table("hhea") + 34)[0]
+        offset = self._table("hmtx")
+        self.advances = [
+            struct.unpack_from(">H", data, offset + i * 4)[0]
+            for i in range(number_of_metrics)]
+        self.cmap = self._read_cmap()
+        self.extents = self._read_extents()
+        self.data = None
+
+    def _read_cmap(self):
+        data = self.data
+        offset = self._table("cmap")
+        count = struct.unpack_from(">H", data, offset + 2)[0]
+        subtables = {}
+        for i in range(count):
+            platform, encoding, subtable_offset = \
+                struct.unpack_from(">HHI", data, offset + 4 + i * 8)
+            subtables[(platform, encoding)] = offset + subtable_offset
+        for platform_encoding in ((3, 10), (0, 4), (3, 1), (0, 3), (0, 1)):
+            if platform_encoding in subtables:
+                subtable = subtables[platform_encoding]
+                break
+        else:
+            raise FontFormatError("No unicode cmap")
+
+        format = struct.unpack_from(">H", data, subtable)[0]
+        cmap = {}
+        if format == 4:
+            seg_count = struct.unpack_from(">H", data, subtable + 6)[0] // 2
+            ends = subtable + 14
+            starts = ends + seg_count * 2 + 2
+            deltas = starts + seg_count * 2
+            range_offsets = deltas + seg_count * 2
+            for i in range(seg_count):
+                end = struct.unpack_from(">H", data, ends + i * 2)[0]
+                start = struct.unpack_from(">H", data, starts + i * 2)[0]
+                delta = struct.unpack_from(">h", data, deltas + i * 2)[0]
+                range_offset_pos = range_offsets + i * 2
+                range_offset = struct.unpack_from(
+                    ">H", data, range_offset_pos)[0]
+                for c in range(start, end + 1):
+                    if c == 0xffff:
+                        continue
+                    if range_offset == 0:
+                        glyph = (c + delta) & 0xffff
+                    else:
+                        pos = range_offset_pos + range_offset + \
+                            (c - start) * 2
+                        glyph = struct.unpack_from(">H", data, pos)[0]
+                        if glyph:
+                            glyph = (glyph + delta) & 0xffff
+                    if glyph:
+                        cmap[c] = glyph
+        elif format == 12:
+            groups = struct.unpack_from(">I", data, subtable + 12)[0]
+            for i in range(groups):
+                start, end, glyph = struct.unpack_from(
+                    ">III", data, subtable + 16 + i * 12)
+                for c in range(start, end + 1):
+                    cmap[c] = glyph + c - start
+        else:
+            raise FontFormatError("Unsupported cmap format {}".format(format))
+        return cmap
+
+    def _read_extents(self):
+        # Horizontal ink extents of glyphs; only TrueType outlines have them
+        if "glyf" not in self.tables or "loca" not in self.tables:
+            return None
+        data = self.data
+        long_offsets = struct.unpack_from(
+            ">h", data, self._table("head") + 50)[0]
+        loca, loca_length = self.tables["loca"]
+        glyf = self._table("glyf")
+        if long_offsets:
+            offsets = struct.unpack_from(
+                ">{}I".format(loca_length // 4), data, loca)
+        else:
+            offsets = [o * 2 for o in struct.unpack_from(
+                ">{}H".format(loca_length // 2), data, loca)]
+        extents = []
+        for start, end in zip(offsets, offsets[1:]):
+            if start == end:
+                extents.append(None)  # Glyph without outline
+            else:
+                x_min, y_min, x_max = struct.unpack_from(
+                    ">hhh", data, glyf + start + 2)
+                extents.append((x_min, x_max))
+        return extents
+
+    def get_glyph(self, char):
+        return self.cmap.get(ord(char), 0)
+
+    def get_glyph_metrics(self, glyph):
+        advances = self.advances
+        advance = advances[min(glyph, len(advances) - 1)]
+        if self.extents is None:
+            return advance, (0, advance)
+        if glyph < len(self.extents):
+            return advance, self.extents[glyph]
+        return advance, None
+
+
+def _read_name(data, name_ids):
+    # 'data' is the name table
+    format, count, string_offset = struct.unpack_from(">HHH", data, 0)
+    names = {}
+    for i in range(count):
+        platform, encoding, language, name_id, length, value_offset = \
+            struct.unpack_from(">HHHHHH", data, 6 + i * 12)
+        if name_id not in name_ids:
+            continue
+        start = string_offset + value_offset
+        raw = data[start:start + length]
+        if platform == 3 or platform == 0:
+            value = raw.decode("utf-16-be", "replace")
+        elif platform == 1:
+            value = raw.decode("latin-1")
+        else:
+            continue
+        # Prefer Windows English names
+        if name_id not in names or (platform == 3 and language == 0x409):
+            names[name_id] = value
+    for name_id in name_ids:
+        if name_id in names:
+            return names[name_id]
+    raise FontFormatError("Font has no family name")
+
+
+class FontMetrics:
+
+    def __init__(self, font_dirs=FONT_DIRS):
+        self.font_dirs = font_dirs
+        self.families = None
+        self.lock = threading.Lock()
+
+    def _scan(self):
+        families = {}
+        for directory in self.font_dirs:
+            directory = os.path.expanduser(directory)
+            for root, dirs, files in os.walk(directory):
+                for filename in sorted(files):
+                    if not filename.lower().endswith(FONT_EXTENSIONS):
+                        continue
+                    try:
+                        font = Font(os.path.join(root, filename))
+                    except (FontFormatError, struct.error, OSError):
+                        continue
+                    families.setdefault(
+                        font.family.lower(), []).append(font)
+        return families
+
+    def find_font(self, family, bold, italic):
+        with self.lock:
+            if self.families is None:
+                self.families = self._scan()
+            fonts = self.families.get(family.lower())
+            if not fonts:
+                return None
+            font = min(fonts, key=lambda f: (f.italic != italic) * 2 +
+                       (f.bold != bold))
+            if font.advances is None:
+                font._load_metrics()
+            return font
+
+    def get_text_width(self, text, style, styles, anchor=None):
+        # Returns None when a font is not available
+        if anchor is None:
+            anchor = {"center": 0.5, "right": 1.0}.get(style.align, 0.0)
+
+        active_styles = [style]
+        lines = [[]]
+        for token_type, value in text:
+            if token_type == "text":
+                lines[-1].append((value, active_styles[:]))
+            elif token_type == "newline":
+                lines.extend([] for i in range(value))
+            elif token_type == "begin":
+                active_styles.append(styles[value])
+            elif token_type == "end":
+                active_styles.pop()
+            else:
+                raise Exception("Invalid token")
+
+        left = None
+        right = None
+        for line in lines:
+            x = 0
+            ink_left = None
+            ink_right = None
+            for value, active in line:
+                font_name = None
+                size = None
+                for s in active:
+                    if s.font:
+                        font_name = s.font
+                    if s.size:
+                        size = s.size
+                bold = any(s.bold for s in active)
+                italic = any(s.italic for s in active)
+                if font_name is None or size is None:
+                    return None
+                font = self.find_font(font_name, bold, italic)
+                if font is None:
+                    return None
+                scale = size / font.units_per_em
+                for char in value:
+                    advance, extent = font.get_glyph_metrics(
+                        font.get_glyph(char))
+                    if extent is not None:
+                        start = x + extent[0] * scale
+                        end = x + extent[1] * scale
+                        if ink_left is None or start < ink_left:
+                            ink_left = start
+                        if ink_right is None or end > ink_right:
+                            ink_right = end
+                    x += advance * scale
+            if ink_left is None:
+                continue
+            offset = -x * anchor
+            if left is None or ink_left + offset < left:
+                left = ink_left + offset
+            if right is None or ink_right + offset > right:
+                right = ink_right + offset
+
+        if left is None:
+            return 0.0
+        return right - left
+
+
+class FontMetricsEngine:
+
+    def __init__(self, fallback, verify=False, tolerance=0.02,
+                 font_metrics=None):
+        if font_metrics is None:
+            font_metrics = FontMetrics()
+        self.font_metrics = font_metrics
+        self.fallback = fallback
+        self.verify = verify
+        self.tolerance = tolerance
+        self.mismatches = []
+        self.lock = threading.Lock()
+
+    def compute(self, queries):
+        results = []
+        missing = []
+        for i, query in enumerate(queries):
+            width = self.font_metrics.get_text_width(
+                query.text, query.style, query.styles)
+            if width is None:
+                missing.append(i)
+                results.append(None)
+            else:
+                results.append((width, query.get_height()))
+
+        if self.verify:
+            expected = self.fallback.compute(queries)
+            for query, result, expected_result in \
+                    zip(queries, results, expected):
+                if result is None:
+                    continue
+                width = result[0]
+                expected_width = expected_result[0]
+                if abs(width - expected_width) > \
+                        self.tolerance * max(expected_width, 1.0):
+                    with self.lock:
+                        self.mismatches.append(
+                            (query.text, expected_width, width))
+            return expected
+
+        if missing:
+            fallback_results = self.fallback.compute(
+                [queries[i] for i in missing])
+            for i, result in zip(missing, fallback_results):
+                results[i] = result
+        return results
@@ -0,0 +1,212 @@
+from elphie.svg import string_to_pixels
+
+import lxml.etree as et
+from copy import deepcopy
+import os
+import re
+import threading
+
+
+class ImageData:
+
+    # One version of an SVG file; shared by all images that show it
+
+    def __init__(self, key, metadata=None):
+        self.key = key
+        self.filename = key[0]
+        self.metadata_loaded = metadata is not None
+        self._metadata = metadata
+        self._root = None
+        self._chunks = None
+        self._variants = {}
+
+    def __getstate__(self):
+        # lxml trees cannot be pickled
+        state = self.__dict__.copy()
+        if self._root is not None:
+            state["_root"] = et.tostring(self._root)
+        state["_variants"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._root is not None:
+            self._root = et.fromstring(self._root)
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = et.parse(self.filename).getroot()
+        return self._root
+
+    @property
+    def metadata(self):
+        # (width, height, labels, max_step) without a scale and a show offset
+        if self._metadata is None:
+            root = self.root
+            labels = set()
+            max_step = 1
+            for element in root.iter():
+                value = _parse_label(element)
+                if value is None:
+                    continue
+                labels.add(value)
+                start, end = value
+                max_step = max(max_step, start if end is None else end)
+            self._metadata = (string_to_pixels(root.get("width")),
+                              string_to_pixels(root.get("height")),
+                              sorted(labels, key=repr),
+                              max_step)
+        return self._metadata
+
+    @property
+    def width(self):
+        return self.metadata[0]
+
+    @property
+    def height(self):
+        return self.metadata[1]
+
+    @property
+    def labels(self):
+        return self.metadata[2]
+
+    @property
+    def max_step(self):
+        return self.metadata[3]
+
+    @property
+    def has_inner_steps(self):
+        return self.max_step > 1
+
+    def get_inner_state(self, step):
+        if not self.has_inner_steps:
+            return ()
+        return tuple(start <= step and (end is None or step <= end)
+                     for start, end in self.labels)
+
+    def get_variant(self, step):
+        key = self.get_inner_state(step)
+        data = self._variants.get(key)
+        if data is None:
+            visible = dict(zip(self.labels, key))
+            data = "".join(text for text, labels in self._get_chunks()
+                           if all(visible[label] for label in labels))
+            self._variants[key] = data
+        return data
+
+    def _get_chunks(self):
+        if self._chunks is None:
+            if self.has_inner_steps:
+                self._chunks = _split_by_labels(self.root)
+            else:
+                self._chunks = [(et.tostring(self.root).decode(), ())]
+        return self._chunks
+
+
+class ImageStore:
+
+    # Images are identified by the path, mtime and size of their file
+
+    def __init__(self):
+        self.images = {}
+        self.metadata_cache = None
+        self.lock = threading.Lock()
+
+    def get(self, filename):
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        key = (filename, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            data = self.images.get(key)
+            if data is None:
+                metadata = None
+                if self.metadata_cache is not None:
+                    metadata = self.metadata_cache.get(key)
+                data = ImageData(key, metadata)
+                self.images[key] = data
+            return data
+
+    def open_metadata(self, store):
+        # The store has the interface of QueryCache
+        self.metadata_cache = store
+
+    def close_metadata(self):
+        # Stores metadata measured since open_metadata()
+        cache = self.metadata_cache
+        if cache is None:
+            return
+        with self.lock:
+            self.metadata_cache = None
+            items = [(key, data.metadata)
+                     for key, data in self.images.items()
+                     if data._metadata is not None and
+                     not data.metadata_loaded]
+            for key, data in self.images.items():
+                data.metadata_loaded = data._metadata is not None
+        try:
+            cache.put_many(items)
+            # The cache may be shared by other decks, so entries are
+            # dropped only when their files changed
+            live_keys = [key for key, metadata in cache.items()
+                         if _is_current(key)]
+            if cache.needs_compaction(live_keys):
+                cache.compact(live_keys)
+        finally:
+            cache.close()
+
+
+image_store = ImageStore()
+
+
+def _is_current(key):
+    filename, mtime_ns, size = key
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return False
+    return stat.st_mtime_ns == mtime_ns and stat.st_size == size
+
+
+def _parse_label(element):
+    label = element.get("{http://www.inkscape.org/namespaces/inkscape}label")
+    if label is None:
+        return None
+    pos = label.find("**")
+    if pos == -1:
+        return None
+    label = label[pos + 2:].strip()
+    if label.isdigit():
+        return int(label), None
+    parts = label.split("-")
+    if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+        return int(parts[0]), int(parts[1])
+    return None
+
+
+def _split_by_labels(root):
+    # Serializes the tree once; returns pairs (text, labels) where labels
+    # are show values of all labelled elements that enclose the text
+    root = deepcopy(root)
+    labelled = []
+    for element in root.iter(et.Element):
+        value = _parse_label(element)
+        if value is not None and element is not root:
+            labelled.append((element, value))
+    for i, (element, value) in enumerate(labelled):
+        element.addprevious(et.ProcessingInstruction("elphie-begin", str(i)))
+        element.addnext(et.ProcessingInstruction("elphie-end", str(i)))
+
+    parts = re.split(r"<\?elphie-(begin|end) (\d+)\?>",
+                     et.tostring(root).decode())
+    chunks = [(parts[0], ())]
+    labels = []
+    for i in range(1, len(parts), 3):
+        kind, index, text = parts[i:i + 3]
+        if kind == "begin":
+            labels.append(labelled[int(index)][1])
+        else:
+            labels.pop()
+        if text:
+            chunks.append((text, tuple(labels)))
+    return chunks
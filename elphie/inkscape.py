@@ -0,0 +1,158 @@
+
+from elphie.trace import tracer
+
+import os
+import queue
+import select
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+
+INKSCAPE = "/usr/bin/inkscape"
+
+# Seconds to wait for an answer of the Inkscape shell
+INKSCAPE_TIMEOUT = 120
+
+
+class InkscapeError(Exception):
+    pass
+
+
+class InkscapeWorker:
+
+    def __init__(self, tmp_dir, name, executable=INKSCAPE,
+                 timeout=INKSCAPE_TIMEOUT):
+        self.source = os.path.join(tmp_dir, name + ".svg")
+        self.target = os.path.join(tmp_dir, name + ".pdf")
+        self.timeout = timeout
+        self.process = subprocess.Popen(
+            (executable, "--without-gui", "--shell"),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        try:
+            self._wait_for_prompt()
+        except InkscapeError:
+            self.kill()
+            raise
+
+    def _wait_for_prompt(self):
+        # The shell prints '>' at the beginning of a line when it is ready
+        fd = self.process.stdout.fileno()
+        deadline = time.monotonic() + self.timeout
+        line_start = True
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise InkscapeError("Inkscape worker does not respond")
+            data = os.read(fd, 4096)
+            if not data:
+                raise InkscapeError("Inkscape worker terminated")
+            for c in data:
+                if c == 62 and line_start:  # '>'
+                    return
+                line_start = c == 10  # '\n'
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def convert(self, source, target):
+        with open(self.source, "wb") as f:
+            f.write(source)
+        if os.path.exists(self.target):
+            os.remove(self.target)
+        command = "{} -A {}\n".format(self.source, self.target)
+        with tracer.span("inkscape shell", "subprocess",
+                         worker=self.process.pid, bytes=len(source)):
+            try:
+                self.process.stdin.write(command.encode())
+                self.process.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                raise InkscapeError("Inkscape worker terminated")
+            self._wait_for_prompt()
+        if not os.path.isfile(self.target):
+            raise InkscapeError("Inkscape did not produce '{}'".format(target))
+        shutil.move(self.target, target)
+
+    def close(self):
+        if self.is_alive():
+            try:
+                self.process.stdin.write(b"quit\n")
+                self.process.stdin.close()
+                self.process.wait(10)
+                return
+            except (BrokenPipeError, ValueError, subprocess.TimeoutExpired):
+                pass
+        self.kill()
+
+    def kill(self):
+        if self.is_alive():
+            self.process.kill()
+        self.process.wait()
+
+
+class InkscapePool:
+
+    def __init__(self, size, executable=INKSCAPE, timeout=INKSCAPE_TIMEOUT):
+        assert size > 0
+        self.size = size
+        self.executable = executable
+        self.timeout = timeout
+        self.tmp_dir = tempfile.mkdtemp(prefix="elphie-inkscape-")
+        self.idle = queue.LifoQueue()
+        self.workers = []
+        self.lock = threading.Lock()
+        self.counter = 0
+        for i in range(size):
+            self.idle.put(None)  # Slot for a lazily started worker
+
+    def _start_worker(self):
+        with self.lock:
+            self.counter += 1
+            name = "worker-{}".format(self.counter)
+        worker = InkscapeWorker(
+            self.tmp_dir, name, self.executable, self.timeout)
+        with self.lock:
+            self.workers.append(worker)
+        return worker
+
+    def _stop_worker(self, worker):
+        worker.kill()
+        with self.lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+
+    def convert(self, source, target):
+        worker = self.idle.get()
+        try:
+            if worker is not None and not worker.is_alive():
+                self._stop_worker(worker)
+                worker = None
+            if worker is None:
+                worker = self._start_worker()
+            try:
+                worker.convert(source, target)
+            except InkscapeError:
+                # Restart the worker and give the conversion a second chance
+                self._stop_worker(worker)
+                worker = None
+                worker = self._start_worker()
+                worker.convert(source, target)
+        except InkscapeError:
+            if worker is not None:
+                self._stop_worker(worker)
+                worker = None
+            raise
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        with self.lock:
+            workers = self.workers
+            self.workers = []
+        for worker in workers:
+            worker.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
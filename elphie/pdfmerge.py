@@ -0,0 +1,484 @@
+
+import re
+import zlib
+
+
+class PdfError(Exception):
+    pass
+
+
+class Name(bytes):
+    pass
+
+
+class Ref:
+
+    __slots__ = ("number", "generation")
+
+    def __init__(self, number, generation):
+        self.number = number
+        self.generation = generation
+
+    def __repr__(self):
+        return "<Ref {} {}>".format(self.number, self.generation)
+
+
+class Raw(bytes):
+    # Numbers, strings, booleans and null are copied as they were written
+    pass
+
+
+WHITESPACE = b"\x00\t\n\x0c\r "
+TOKEN_END = re.compile(rb"[\x00\t\n\x0c\r ()<>\[\]{}/%]")
+INTEGER = re.compile(rb"[+-]?\d+$")
+
+INHERITED_PAGE_ATTRIBUTES = (b"Resources", b"MediaBox", b"CropBox", b"Rotate")
+
+
+class Parser:
+
+    def __init__(self, data, position=0):
+        self.data = data
+        self.position = position
+
+    def skip_whitespace(self):
+        data = self.data
+        position = self.position
+        length = len(data)
+        while position < length:
+            c = data[position]
+            if c in WHITESPACE:
+                position += 1
+            elif c == 37:  # '%'
+                while position < length and data[position] not in b"\r\n":
+                    position += 1
+            else:
+                break
+        self.position = position
+
+    def read_token(self):
+        self.skip_whitespace()
+        data = self.data
+        start = self.position
+        if start >= len(data):
+            raise PdfError("Unexpected end of data")
+        c = data[start:start + 1]
+        if c in (b"[", b"]", b"{", b"}", b"(", b"/"):
+            self.position = start + 1
+            return c
+        if c == b"<" or c == b">":
+            if data[start + 1:start + 2] == c:
+                self.position = start + 2
+                return c * 2
+            self.position = start + 1
+            return c
+        match = TOKEN_END.search(data, start)
+        end = match.start() if match else len(data)
+        self.position = end
+        return data[start:end]
+
+    def read_object(self):
+        token = self.read_token()
+        if token == b"<<":
+            result = {}
+            while True:
+                self.skip_whitespace()
+                if self.data.startswith(b">>", self.position):
+                    self.position += 2
+                    return result
+                key = self.read_object()
+                if not isinstance(key, Name):
+                    raise PdfError("Invalid dictionary key")
+                result[key] = self.read_object()
+        if token == b"[":
+            result = []
+            while True:
+                self.skip_whitespace()
+                if self.data.startswith(b"]", self.position):
+                    self.position += 1
+                    return result
+                result.append(self.read_object())
+        if token == b"/":
+            match = TOKEN_END.search(self.data, self.position)
+            end = match.start() if match else len(self.data)
+            name = Name(self.data[self.position:end])
+            self.position = end
+            return name
+        if token == b"(":
+            return self._read_literal_string(self.position - 1)
+        if token == b"<":
+            start = self.position - 1
+            end = self.data.index(b">", start)
+            self.position = end + 1
+            return Raw(self.data[start:end + 1])
+        if INTEGER.match(token):
+            # Check for a reference "number generation R"
+            position = self.position
+            try:
+                generation = self.read_token()
+                keyword = self.read_token()
+            except PdfError:
+                keyword = None
+            if keyword == b"R" and INTEGER.match(generation):
+                return Ref(int(token), int(generation))
+            self.position = position
+            return Raw(token)
+        if token in (b"]", b">>", b">", b")", b"{", b"}"):
+            raise PdfError("Unexpected token {!r}".format(token))
+        return Raw(token)
+
+    def _read_literal_string(self, start):
+        data = self.data
+        position = start + 1
+        depth = 1
+        while depth:
+            if position >= len(data):
+                raise PdfError("Unterminated string")
+            c = data[position]
+            if c == 92:  # '\'
+                position += 2
+                continue
+            if c == 40:  # '('
+                depth += 1
+            elif c == 41:  # ')'
+                depth -= 1
+            position += 1
+        self.position = position
+        return Raw(data[start:position])
+
+
+def serialize(value, map_ref):
+    if isinstance(value, Name):
+        return b"/" + value
+    if isinstance(value, Raw):
+        return bytes(value)
+    if isinstance(value, Ref):
+        return "{} 0 R".format(map_ref(value)).encode()
+    if isinstance(value, dict):
+        parts = [b"<<"]
+        for key, item in value.items():
+            parts.append(b"/" + key)
+            parts.append(serialize(item, map_ref))
+        parts.append(b">>")
+        return b" ".join(parts)
+    if isinstance(value, list):
+        return b"[" + b" ".join(serialize(item, map_ref)
+                                for item in value) + b"]"
+    raise PdfError("Cannot serialize {!r}".format(value))
+
+
+def _png_unpredict(data, columns):
+    row_size = columns + 1
+    previous = bytearray(columns)
+    result = bytearray()
+    for row_start in range(0, len(data), row_size):
+        kind = data[row_start]
+        row = bytearray(data[row_start + 1:row_start + row_size])
+        if kind == 1:
+            for i in range(1, len(row)):
+                row[i] = (row[i] + row[i - 1]) & 0xff
+        elif kind == 2:
+            for i in range(len(row)):
+                row[i] = (row[i] + previous[i]) & 0xff
+        elif kind == 3:
+            for i in range(len(row)):
+                left = row[i - 1] if i else 0
+                row[i] = (row[i] + (left + previous[i]) // 2) & 0xff
+        elif kind == 4:
+            for i in range(len(row)):
+                a = row[i - 1] if i else 0
+                b = previous[i]
+                c = previous[i - 1] if i else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    predictor = a
+                elif pb <= pc:
+                    predictor = b
+                else:
+                    predictor = c
+                row[i] = (row[i] + predictor) & 0xff
+        elif kind != 0:
+            raise PdfError("Invalid PNG predictor")
+        result += row
+        previous = row
+    return bytes(result)
+
+
+def decode_stream(reader, stream_dict, data):
+    filters = reader.resolve(stream_dict.get(b"Filter"))
+    if filters is None:
+        return data
+    if not isinstance(filters, list):
+        filters = [filters]
+    parms = reader.resolve(stream_dict.get(b"DecodeParms"))
+    if len(filters) != 1 or filters[0] != b"FlateDecode":
+        raise PdfError("Unsupported stream filter")
+    data = zlib.decompress(data)
+    if isinstance(parms, list):
+        parms = parms[0]
+    if parms:
+        predictor = int(reader.resolve(parms.get(b"Predictor", Raw(b"1"))))
+        if predictor >= 10:
+            columns = int(reader.resolve(parms.get(b"Columns", Raw(b"1"))))
+            data = _png_unpredict(data, columns)
+        elif predictor != 1:
+            raise PdfError("Unsupported predictor")
+    return data
+
+
+class PdfReader:
+
+    def __init__(self, filename=None, data=None):
+        if data is None:
+            with open(filename, "rb") as f:
+                data = f.read()
+        self.data = data
+        # object number -> (1, offset) or (2, object stream, index)
+        self.xref = {}
+        self.object_streams = {}
+        self.trailer = None
+        self._read_xref()
+        if b"Encrypt" in self.trailer:
+            raise PdfError("Encrypted PDF files are not supported")
+
+    def _read_xref(self):
+        data = self.data
+        position = data.rfind(b"startxref")
+        if position == -1:
+            raise PdfError("startxref not found")
+        parser = Parser(data, position + len(b"startxref"))
+        offset = int(parser.read_token())
+        visited = set()
+        while offset is not None and offset not in visited:
+            visited.add(offset)
+            parser = Parser(data, offset)
+            parser.skip_whitespace()
+            if data.startswith(b"xref", parser.position):
+                parser.position += 4
+                trailer = self._read_xref_table(parser)
+                if b"XRefStm" in trailer:
+                    self._read_xref_stream(int(trailer[b"XRefStm"]))
+            else:
+                trailer = self._read_xref_stream(offset)
+            if self.trailer is None:
+                self.trailer = trailer
+            prev = trailer.get(b"Prev")
+            offset = int(prev) if prev is not None else None
+
+    def _read_xref_table(self, parser):
+        xref = self.xref
+        while True:
+            token = parser.read_token()
+            if token == b"trailer":
+                return parser.read_object()
+            start = int(token)
+            count = int(parser.read_token())
+            for number in range(start, start + count):
+                offset = parser.read_token()
+                parser.read_token()  # generation
+                kind = parser.read_token()
+                if kind == b"n" and number not in xref:
+                    xref[number] = (1, int(offset))
+
+    def _read_xref_stream(self, offset):
+        number, stream_dict, data = self._read_indirect(offset)
+        data = decode_stream(self, stream_dict, data)
+        widths = [int(w) for w in stream_dict[b"W"]]
+        size = int(stream_dict[b"Size"])
+        index = stream_dict.get(b"Index", [Raw(b"0"), Raw(str(size).encode())])
+        index = [int(i) for i in index]
+        position = 0
+        xref = self.xref
+        for start, count in zip(index[::2], index[1::2]):
+            for number in range(start, start + count):
+                fields = []
+                for width in widths:
+                    value = 0
+                    for i in range(width):
+                        value = (value << 8) | data[position + i]
+                    position += width
+                    fields.append(value)
+                if widths[0] == 0:
+                    fields[0] = 1
+                if number in xref:
+                    continue
+                if fields[0] == 1:
+                    xref[number] = (1, fields[1])
+                elif fields[0] == 2:
+                    xref[number] = (2, fields[1], fields[2])
+        return stream_dict
+
+    def _read_indirect(self, offset):
+        parser = Parser(self.data, offset)
+        number = int(parser.read_token())
+        parser.read_token()  # generation
+        if parser.read_token() != b"obj":
+            raise PdfError("Invalid object at offset {}".format(offset))
+        value = parser.read_object()
+        parser.skip_whitespace()
+        stream = None
+        if self.data.startswith(b"stream", parser.position):
+            start = parser.position + len(b"stream")
+            if self.data.startswith(b"\r\n", start):
+                start += 2
+            elif self.data.startswith(b"\n", start):
+                start += 1
+            length = self.resolve(value.get(b"Length"))
+            if length is not None:
+                end = start + int(length)
+            else:
+                end = self.data.index(b"endstream", start)
+            stream = self.data[start:end]
+        return number, value, stream
+
+    def _get_object_stream(self, number):
+        objects = self.object_streams.get(number)
+        if objects is not None:
+            return objects
+        stream_dict, data = self.get_object(number)
+        data = decode_stream(self, stream_dict, data)
+        count = int(stream_dict[b"N"])
+        first = int(stream_dict[b"First"])
+        parser = Parser(data)
+        header = [int(parser.read_token()) for i in range(count * 2)]
+        objects = {}
+        for object_number, offset in zip(header[::2], header[1::2]):
+            objects[object_number] = Parser(data, first + offset).read_object()
+        self.object_streams = {number: objects}  # Keep only the last one
+        return objects
+
+    def get_object(self, number):
+        # Returns (value, raw stream data or None)
+        entry = self.xref.get(number)
+        if entry is None:
+            return Raw(b"null"), None
+        if entry[0] == 1:
+            found, value, stream = self._read_indirect(entry[1])
+            return value, stream
+        return self._get_object_stream(entry[1])[number], None
+
+    def resolve(self, value):
+        while isinstance(value, Ref):
+            value = self.get_object(value.number)[0]
+        return value
+
+    def get_pages(self):
+        # Returns [(object number, dict with inherited attributes)]
+        root = self.resolve(self.trailer[b"Root"])
+        pages = []
+        nodes = set()
+
+        def walk(ref, inherited):
+            node = self.resolve(ref)
+            if node.get(b"Type") == b"Pages" or b"Kids" in node:
+                nodes.add(ref.number)
+                inherited = inherited.copy()
+                for name in INHERITED_PAGE_ATTRIBUTES:
+                    if name in node:
+                        inherited[name] = node[name]
+                for kid in self.resolve(node[b"Kids"]):
+                    walk(kid, inherited)
+            else:
+                page = node.copy()
+                for name, value in inherited.items():
+                    page.setdefault(name, value)
+                pages.append((ref.number, page))
+
+        walk(root[b"Pages"], {})
+        return pages, nodes
+
+
+class PdfMerger:
+
+    # Pages are written to the output as soon as they are appended,
+    # only the object offsets and page numbers are kept in memory
+
+    def __init__(self, filename):
+        self.file = open(filename, "wb")
+        self.offsets = []
+        self.pages = []
+        self.file.write(b"%PDF-1.5\n%\xe2\xe3\xcf\xd3\n")
+        self.pages_number = self._allocate()
+
+    def _allocate(self):
+        self.offsets.append(None)
+        return len(self.offsets)
+
+    def _write_object(self, number, value, stream=None, map_ref=None):
+        self.offsets[number - 1] = self.file.tell()
+        if stream is not None:
+            value = value.copy()
+            value[Name(b"Length")] = Raw(str(len(stream)).encode())
+        chunks = ["{} 0 obj\n".format(number).encode(),
+                  serialize(value, map_ref)]
+        if stream is not None:
+            chunks.append(b"\nstream\n")
+            chunks.append(stream)
+            chunks.append(b"\nendstream")
+        chunks.append(b"\nendobj\n")
+        self.file.write(b"".join(chunks))
+
+    def append(self, filename):
+        self.append_reader(PdfReader(filename))
+
+    def append_data(self, data):
+        self.append_reader(PdfReader(data=data))
+
+    def append_reader(self, reader):
+        pages, page_nodes = reader.get_pages()
+        queue = []
+
+        # Parents of pages are replaced by the root of the output page tree
+        numbers = dict((number, self.pages_number) for number in page_nodes)
+        page_numbers = []
+        for number, page in pages:
+            new_number = self._allocate()
+            numbers[number] = new_number
+            page_numbers.append(new_number)
+
+        def map_ref(ref):
+            new_number = numbers.get(ref.number)
+            if new_number is None:
+                new_number = self._allocate()
+                numbers[ref.number] = new_number
+                queue.append(ref.number)
+            return new_number
+
+        for (number, page), new_number in zip(pages, page_numbers):
+            self._write_object(new_number, page, map_ref=map_ref)
+            while queue:
+                old_number = queue.pop()
+                value, stream = reader.get_object(old_number)
+                self._write_object(
+                    numbers[old_number], value, stream, map_ref)
+        self.pages.extend(page_numbers)
+
+    def close(self):
+        kids = b" ".join("{} 0 R".format(number).encode()
+                         for number in self.pages)
+        self.offsets[self.pages_number - 1] = self.file.tell()
+        self.file.write("{} 0 obj\n<< /Type /Pages /Count {} /Kids [".format(
+            self.pages_number, len(self.pages)).encode() + kids +
+            b"] >>\nendobj\n")
+        catalog = self._allocate()
+        self.offsets[catalog - 1] = self.file.tell()
+        self.file.write("{} 0 obj\n<< /Type /Catalog /Pages {} 0 R >>\n"
+                        "endobj\n".format(
+                            catalog, self.pages_number).encode())
+
+        xref_offset = self.file.tell()
+        lines = ["xref\n0 {}\n0000000000 65535 f \n".format(
+            len(self.offsets) + 1)]
+        for offset in self.offsets:
+            lines.append("{:010d} 00000 n \n".format(offset))
+        lines.append("trailer\n<< /Size {} /Root {} 0 R >>\n"
+                     "startxref\n{}\n%%EOF\n".format(
+                         len(self.offsets) + 1, catalog, xref_offset))
+        self.file.write("".join(lines).encode())
+        self.file.close()
+
+    def discard(self):
+        # Closes an unfinished output; it is not a valid PDF
+        if not self.file.closed:
+            self.file.close()
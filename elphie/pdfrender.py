@@ -0,0 +1,421 @@
+
+from elphie.svg import Renderer
+
+import hashlib
+import json
+import math
+
+# Pixels in slides are CSS pixels (96 per inch), PDF uses points
+PX_TO_PT = 0.75
+
+# Resolution of bitmaps rendered from SVG images
+IMAGE_DPI = 300
+
+# Color keywords of SVG
+COLORS = {
+    "aliceblue": (240, 248, 255),
+    "antiquewhite": (250, 235, 215),
+    "aqua": (0, 255, 255),
+    "aquamarine": (127, 255, 212),
+    "azure": (240, 255, 255),
+    "beige": (245, 245, 220),
+    "bisque": (255, 228, 196),
+    "black": (0, 0, 0),
+    "blanchedalmond": (255, 235, 205),
+    "blue": (0, 0, 255),
+    "blueviolet": (138, 43, 226),
+    "brown": (165, 42, 42),
+    "burlywood": (222, 184, 135),
+    "cadetblue": (95, 158, 160),
+    "chartreuse": (127, 255, 0),
+    "chocolate": (210, 105, 30),
+    "coral": (255, 127, 80),
+    "cornflowerblue": (100, 149, 237),
+    "cornsilk": (255, 248, 220),
+    "crimson": (220, 20, 60),
+    "cyan": (0, 255, 255),
+    "darkblue": (0, 0, 139),
+    "darkcyan": (0, 139, 139),
+    "darkgoldenrod": (184, 134, 11),
+    "darkgray": (169, 169, 169),
+    "darkgreen": (0, 100, 0),
+    "darkgrey": (169, 169, 169),
+    "darkkhaki": (189, 183, 107),
+    "darkmagenta": (139, 0, 139),
+    "darkolivegreen": (85, 107, 47),
+    "darkorange": (255, 140, 0),
+    "darkorchid": (153, 50, 204),
+    "darkred": (139, 0, 0),
+    "darksalmon": (233, 150, 122),
+    "darkseagreen": (143, 188, 143),
+    "darkslateblue": (72, 61, 139),
+    "darkslategray": (47, 79, 79),
+    "darkslategrey": (47, 79, 79),
+    "darkturquoise": (0, 206, 209),
+    "darkviolet": (148, 0, 211),
+    "deeppink": (255, 20, 147),
+    "deepskyblue": (0, 191, 255),
+    "dimgray": (105, 105, 105),
+    "dimgrey": (105, 105, 105),
+    "dodgerblue": (30, 144, 255),
+    "firebrick": (178, 34, 34),
+    "floralwhite": (255, 250, 240),
+    "forestgreen": (34, 139, 34),
+    "fuchsia": (255, 0, 255),
+    "gainsboro": (220, 220, 220),
+    "ghostwhite": (248, 248, 255),
+    "gold": (255, 215, 0),
+    "goldenrod": (218, 165, 32),
+    "gray": (128, 128, 128),
+    "grey": (128, 128, 128),
+    "green": (0, 128, 0),
+    "greenyellow": (173, 255, 47),
+    "honeydew": (240, 255, 240),
+    "hotpink": (255, 105, 180),
+    "indianred": (205, 92, 92),
+    "indigo": (75, 0, 130),
+    "ivory": (255, 255, 240),
+    "khaki": (240, 230, 140),
+    "lavender": (230, 230, 250),
+    "lavenderblush": (255, 240, 245),
+    "lawngreen": (124, 252, 0),
+    "lemonchiffon": (255, 250, 205),
+    "lightblue": (173, 216, 230),
+    "lightcoral": (240, 128, 128),
+    "lightcyan": (224, 255, 255),
+    "lightgoldenrodyellow": (250, 250, 210),
+    "lightgray": (211, 211, 211),
+    "lightgreen": (144, 238, 144),
+    "lightgrey": (211, 211, 211),
+    "lightpink": (255, 182, 193),
+    "lightsalmon": (255, 160, 122),
+    "lightseagreen": (32, 178, 170),
+    "lightskyblue": (135, 206, 250),
+    "lightslategray": (119, 136, 153),
+    "lightslategrey": (119, 136, 153),
+    "lightsteelblue": (176, 196, 222),
+    "lightyellow": (255, 255, 224),
+    "lime": (0, 255, 0),
+    "limegreen": (50, 205, 50),
+    "linen": (250, 240, 230),
+    "magenta": (255, 0, 255),
+    "maroon": (128, 0, 0),
+    "mediumaquamarine": (102, 205, 170),
+    "mediumblue": (0, 0, 205),
+    "mediumorchid": (186, 85, 211),
+    "mediumpurple": (147, 112, 219),
+    "mediumseagreen": (60, 179, 113),
+    "mediumslateblue": (123, 104, 238),
+    "mediumspringgreen": (0, 250, 154),
+    "mediumturquoise": (72, 209, 204),
+    "mediumvioletred": (199, 21, 133),
+    "midnightblue": (25, 25, 112),
+    "mintcream": (245, 255, 250),
+    "mistyrose": (255, 228, 225),
+    "moccasin": (255, 228, 181),
+    "navajowhite": (255, 222, 173),
+    "navy": (0, 0, 128),
+    "oldlace": (253, 245, 230),
+    "olive": (128, 128, 0),
+    "olivedrab": (107, 142, 35),
+    "orange": (255, 165, 0),
+    "orangered": (255, 69, 0),
+    "orchid": (218, 112, 214),
+    "palegoldenrod": (238, 232, 170),
+    "palegreen": (152, 251, 152),
+    "paleturquoise": (175, 238, 238),
+    "palevioletred": (219, 112, 147),
+    "papayawhip": (255, 239, 213),
+    "peachpuff": (255, 218, 185),
+    "peru": (205, 133, 63),
+    "pink": (255, 192, 203),
+    "plum": (221, 160, 221),
+    "powderblue": (176, 224, 230),
+    "purple": (128, 0, 128),
+    "red": (255, 0, 0),
+    "rosybrown": (188, 143, 143),
+    "royalblue": (65, 105, 225),
+    "saddlebrown": (139, 69, 19),
+    "salmon": (250, 128, 114),
+    "sandybrown": (244, 164, 96),
+    "seagreen": (46, 139, 87),
+    "seashell": (255, 245, 238),
+    "sienna": (160, 82, 45),
+    "silver": (192, 192, 192),
+    "skyblue": (135, 206, 235),
+    "slateblue": (106, 90, 205),
+    "slategray": (112, 128, 144),
+    "slategrey": (112, 128, 144),
+    "snow": (255, 250, 250),
+    "springgreen": (0, 255, 127),
+    "steelblue": (70, 130, 180),
+    "tan": (210, 180, 140),
+    "teal": (0, 128, 128),
+    "thistle": (216, 191, 216),
+    "tomato": (255, 99, 71),
+    "turquoise": (64, 224, 208),
+    "violet": (238, 130, 238),
+    "wheat": (245, 222, 179),
+    "white": (255, 255, 255),
+    "whitesmoke": (245, 245, 245),
+    "yellow": (255, 255, 0),
+    "yellowgreen": (154, 205, 50),
+}
+
+
+class RendererPDF(Renderer):
+
+    # Records drawing operations; to_bytes() returns them as JSON and
+    # write_pdf() turns such a string into a PDF page through cairo
+
+    debug_suffix = ".json"
+
+    def __init__(self, query_engine=None, query_sources=None):
+        super().__init__(query_engine, query_sources)
+        self.ops = None
+        self.images = None
+
+    def begin(self, width, height):
+        self.width = width
+        self.height = height
+        self.ops = []
+        self.images = {}
+
+    def end(self):
+        pass
+
+    def draw_text(self, x, y, parsed_text, style, styles):
+        used_styles = dict((value, _style_to_dict(styles[value]))
+                           for token_type, value in parsed_text
+                           if token_type == "begin")
+        self.ops.append(("text", x, y, parsed_text,
+                         _style_to_dict(style), used_styles))
+
+    def draw_rect(self,
+                  rect,
+                  fill_color=None,
+                  color=None,
+                  stroke_width=None,
+                  rx=None,
+                  ry=None):
+        if fill_color is None and color is None:
+            color = "black"
+        self.ops.append(("rect", rect.x, rect.y, rect.width, rect.height,
+                         fill_color, color, stroke_width, rx, ry))
+
+    def draw_image(self, svgstring, x, y, scale=1.0):
+        key = hashlib.sha1(svgstring.encode()).hexdigest()
+        self.images[key] = svgstring
+        self.ops.append(("image", key, x, y, scale))
+
+    def begin_fragment(self):
+        return len(self.ops)
+
+    def end_fragment(self, mark):
+        ops = self.ops[mark:]
+        images = dict((op[1], self.images[op[1]])
+                      for op in ops if op[0] == "image")
+        return ops, images
+
+    def draw_fragment(self, fragment):
+        ops, images = fragment
+        self.ops.extend(ops)
+        self.images.update(images)
+
+    def to_string(self):
+        return json.dumps({"width": self.width,
+                           "height": self.height,
+                           "ops": self.ops,
+                           "images": self.images},
+                          sort_keys=True)
+
+    def to_bytes(self):
+        return self.to_string().encode("utf-8")
+
+    def clear(self):
+        self.ops = None
+        self.images = None
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            f.write(self.to_string())
+
+
+def _style_to_dict(style):
+    return dict((a, getattr(style, a)) for a in style.attributes
+                if getattr(style, a) is not None)
+
+
+def parse_color(color):
+    value = color.strip().lower()
+    try:
+        if value.startswith("#"):
+            value = value[1:]
+            if len(value) == 3:
+                value = "".join(c * 2 for c in value)
+            if len(value) != 6:
+                raise ValueError()
+            rgb = tuple(int(value[i:i + 2], 16) for i in (0, 2, 4))
+        elif value.startswith("rgb(") and value.endswith(")"):
+            rgb = tuple(_parse_rgb_component(c)
+                        for c in value[4:-1].split(","))
+            if len(rgb) != 3:
+                raise ValueError()
+        else:
+            rgb = COLORS[value]
+    except (KeyError, ValueError):
+        raise Exception("Invalid color: '{}'".format(color))
+    return tuple(c / 255.0 for c in rgb)
+
+
+def _parse_rgb_component(value):
+    value = value.strip()
+    if value.endswith("%"):
+        return min(255.0, max(0.0, float(value[:-1]) * 255 / 100))
+    return min(255, max(0, int(value)))
+
+
+def _draw_rect(ctx, x, y, width, height,
+               fill_color, color, stroke_width, rx, ry):
+    if rx is None and ry is None:
+        ctx.rectangle(x, y, width, height)
+    else:
+        rx = min(rx if rx is not None else ry, width / 2.0)
+        ry = min(ry if ry is not None else rx, height / 2.0)
+        # Corners are arcs of a unit circle scaled to rx x ry
+        ctx.new_path()
+        ctx.save()
+        ctx.translate(x, y)
+        ctx.scale(rx, ry)
+        w = width / rx
+        h = height / ry
+        ctx.arc(w - 1, 1, 1, -math.pi / 2, 0)
+        ctx.arc(w - 1, h - 1, 1, 0, math.pi / 2)
+        ctx.arc(1, h - 1, 1, math.pi / 2, math.pi)
+        ctx.arc(1, 1, 1, math.pi, 3 * math.pi / 2)
+        ctx.close_path()
+        ctx.restore()
+    if fill_color is not None:
+        ctx.set_source_rgb(*parse_color(fill_color))
+        if color is not None:
+            ctx.fill_preserve()
+        else:
+            ctx.fill()
+    if color is not None:
+        ctx.set_source_rgb(*parse_color(color))
+        ctx.set_line_width(stroke_width if stroke_width is not None else 1)
+        ctx.stroke()
+
+
+def _draw_text(ctx, cairo, x, y, text, style, styles):
+    # Inheritance follows SVG: bold and italic are never switched off
+    active_styles = [style]
+    lines = [[]]
+    for token_type, value in text:
+        if token_type == "text":
+            lines[-1].append((value, active_styles[:]))
+        elif token_type == "newline":
+            lines.extend([] for i in range(value))
+        elif token_type == "begin":
+            active_styles.append(styles[value])
+        elif token_type == "end":
+            active_styles.pop()
+
+    anchor = {"center": 0.5, "right": 1.0}.get(style.get("align"), 0.0)
+    line_size = style["size"] * style["line_spacing"]
+    for line in lines:
+        runs = []
+        width = 0
+        for value, active in line:
+            run = {}
+            for s in active:
+                run.update(s)
+            slant = cairo.FONT_SLANT_ITALIC \
+                if any(s.get("italic") for s in active) \
+                else cairo.FONT_SLANT_NORMAL
+            weight = cairo.FONT_WEIGHT_BOLD \
+                if any(s.get("bold") for s in active) \
+                else cairo.FONT_WEIGHT_NORMAL
+            ctx.select_font_face(run.get("font", "sans-serif"), slant, weight)
+            ctx.set_font_size(run["size"])
+            advance = ctx.text_extents(value)[4]
+            runs.append((value, run, slant, weight, advance))
+            width += advance
+
+        position = x - width * anchor
+        for value, run, slant, weight, advance in runs:
+            ctx.select_font_face(run.get("font", "sans-serif"), slant, weight)
+            ctx.set_font_size(run["size"])
+            ctx.set_source_rgb(*parse_color(run.get("color", "black")))
+            ctx.move_to(position, y)
+            ctx.show_text(value)
+            position += advance
+        y += line_size
+
+
+def write_pdf(source, target, convert_image=None):
+    # SVG images are drawn as vectors by librsvg when it is available;
+    # otherwise convert_image(svg) has to return a PNG file (a filename
+    # or a file object) rendered at IMAGE_DPI
+    import cairo
+
+    rsvg = _load_rsvg()
+    if rsvg is not None:
+        def draw_image(ctx, svg):
+            handle = rsvg.Handle.new_from_data(svg.encode())
+            # Sizes of images in millimeters are computed at 90 DPI
+            handle.set_dpi(90)
+            handle.render_cairo(ctx)
+    else:
+        def draw_image(ctx, svg):
+            if convert_image is None:
+                raise Exception("Drawing of SVG images needs librsvg")
+            image = cairo.ImageSurface.create_from_png(convert_image(svg))
+            ctx.scale(96.0 / IMAGE_DPI, 96.0 / IMAGE_DPI)
+            ctx.set_source_surface(image, 0, 0)
+            ctx.paint()
+
+    document = json.loads(source)
+    surface = cairo.PDFSurface(target,
+                               document["width"] * PX_TO_PT,
+                               document["height"] * PX_TO_PT)
+    draw_document(cairo.Context(surface), cairo, document, draw_image)
+    surface.finish()
+
+
+def draw_document(ctx, cairo, document, draw_image):
+    ctx.scale(PX_TO_PT, PX_TO_PT)
+    images = document["images"]
+    for op in document["ops"]:
+        if op[0] == "rect":
+            _draw_rect(ctx, *op[1:])
+        elif op[0] == "text":
+            _draw_text(ctx, cairo, *op[1:])
+        elif op[0] == "image":
+            key, x, y, scale = op[1:]
+            ctx.save()
+            ctx.translate(x, y)
+            if scale is not None and scale != 1.0:
+                ctx.scale(scale, scale)
+            draw_image(ctx, images[key])
+            ctx.restore()
+        else:
+            raise Exception("Invalid operation")
+
+
+_rsvg = None
+
+
+def _load_rsvg():
+    # librsvg through GObject introspection is optional
+    global _rsvg
+    if _rsvg is None:
+        try:
+            import gi
+            gi.require_version("Rsvg", "2.0")
+            gi.require_foreign("cairo")
+            from gi.repository import Rsvg
+            _rsvg = Rsvg
+        except (ImportError, ValueError):
+            _rsvg = False
+    return _rsvg or None
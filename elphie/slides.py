@@ -1,16 +1,31 @@
 
-from elphie.svg import RendererSVG, run_inkscape
+from elphie.svg import RendererSVG, InkscapeQueryEngine, run_inkscape
+from elphie.inkscape import InkscapePool
+from elphie.fontmetrics import FontMetricsEngine
+from elphie.cache import CACHE_BACKENDS, GarbagePolicy, parse_size
+from elphie.fingerprint import make_fingerprint
+from elphie.pdfmerge import PdfMerger
+from elphie.pdfrender import RendererPDF, write_pdf, IMAGE_DPI
 from elphie.elements import Box
+from elphie.imagestore import image_store
+from elphie.trace import tracer
 from elphie.theme import Theme
 from elphie.textstyle import TextStyle
 
 import hashlib
+import io
 import subprocess
 import os
+import shutil
 import sys
-import pickle
+import tempfile
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import \
+    Future, ThreadPoolExecutor, ProcessPoolExecutor
 
 
 class Slide:
@@ -22,16 +37,53 @@ class Slide:
         self.title = title
         self.element = Box("main")
         self.theme = theme
+        self.query_keys = ()
 
     def get_max_step(self):
         return self.element.get_max_step()
 
+    def get_step_states(self):
+        return [self.element.get_step_state(step)
+                for step in range(1, self.get_max_step() + 1)]
+
+    def get_invariant_elements(self):
+        # Largest subtrees that look the same in all steps where they
+        # are visible
+        steps = range(1, self.get_max_step() + 1)
+        result = set()
+        if len(steps) < 2:
+            return result
+
+        def visit(element):
+            states = set(element.get_step_state(step) for step in steps)
+            states.discard(None)
+            if len(states) == 1:
+                result.add(element)
+            else:
+                for child in element.childs:
+                    visit(child)
+        visit(self.element)
+        return result
+
     def gather_queries(self, ctx):
         queries = []
         self.element.gather_queries(ctx, queries)
         return queries
 
 
+class SlideLayout:
+
+    # Results of the layout that do not depend on the step; shared by
+    # contexts of all steps of one slide
+
+    def __init__(self, invariant_elements=()):
+        self.size_requests = {}
+        self.rects = {}
+        self.text_styles = {}
+        self.invariant_elements = invariant_elements
+        self.fragments = {}
+
+
 class Context(object):
 
     def __init__(self,
@@ -41,27 +93,34 @@ class Context(object):
                  step,
                  query_cache,
                  text_styles,
-                 workers=None):
+                 workers=None,
+                 layout=None):
         self.renderer = renderer
         self.theme = theme
         self.slide = slide
         self.step = step
         self.stack = []
+        if layout is None:
+            layout = SlideLayout()
+        self.layout = layout
         self.query_cache = query_cache
         self.workers = workers
         self.text_styles = theme.text_styles.copy()
         for name, style in text_styles.items():
             self.text_styles[name] = style
 
-    def get_query(self, key):
-        try:
-            return self.query_cache[key]
-        except KeyError:
-            print("Queries:")
-            for q in self.query_cache:
-                print(q)
-            print("Searching for: ", key)
-            raise Exception("Invalid query key")
+    def get_query(self, key, text=None, style=None):
+        # 'text' and 'style' only describe a missing query in the error
+        value = self.query_cache.get(key)
+        if value is None:
+            if text is None or style is None:
+                raise Exception("Query {!r} was not measured".format(key))
+            raise Exception(
+                "Size of text {!r} (font {!r}, size {}, bold {}, italic {}) "
+                "was not measured".format(
+                    _get_text_content(text), style.font, style.size,
+                    bool(style.bold), bool(style.italic)))
+        return value
 
     def push(self, obj):
         self.stack.append(obj)
@@ -70,6 +129,173 @@ class Context(object):
         self.stack.pop()
 
 
+class SlideBuilder:
+
+    # Everything what is needed for the layout and SVG generation;
+    # in the process executor it is sent once to each worker
+
+    renderers = {
+        "svg": RendererSVG,
+        "pdf": RendererPDF,
+    }
+
+    def __init__(self, slides, width, height, text_styles, query_cache,
+                 debug_dir=None, renderer="svg"):
+        self.slides = slides
+        self.width = width
+        self.height = height
+        self.text_styles = text_styles
+        self.query_cache = query_cache
+        self.debug_dir = debug_dir
+        self.renderer = renderer
+        self.layouts = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["layouts"] = {}
+        return state
+
+    def make_context(self, slide, step):
+        layout = self.layouts.get(slide)
+        if layout is None:
+            layout = self.layouts.setdefault(
+                slide, SlideLayout(slide.get_invariant_elements()))
+        return Context(self.renderers[self.renderer](), slide.theme, slide,
+                       step, self.query_cache, self.text_styles,
+                       layout=layout)
+
+    def build(self, ctx):
+        span = tracer.span("render", "render")
+        with span:
+            ctx.renderer.begin(self.width, self.height)
+            ctx.theme.render_slide(ctx)
+            ctx.renderer.end()
+
+        if self.debug_dir:
+            filename = os.path.join(self.debug_dir, "slide-{}-{}{}".format(
+                self.slides.index(ctx.slide), ctx.step,
+                ctx.renderer.debug_suffix))
+            ctx.renderer.write(filename)
+
+        # The page is kept only as one bytes object from now on
+        data = ctx.renderer.to_bytes()
+        ctx.renderer.clear()
+        span.set("bytes", len(data))
+        return data
+
+    def build_steps(self, index, steps):
+        slide = self.slides[index]
+        result = []
+        for step in steps:
+            with tracer.span(_step_name(index, step), "step",
+                             slide=index, step=step):
+                result.append(self.build(self.make_context(slide, step)))
+        self.release(slide)
+        return result
+
+    def release(self, slide):
+        # Called when all steps of the slide are built
+        self.layouts.pop(slide, None)
+
+    def get_fingerprint(self, slide):
+        # Covers everything what can change the look of the slide
+        measurements = [(key, self.query_cache[key])
+                        for key in slide.query_keys]
+        return make_fingerprint(self.renderer,
+                                self.width,
+                                self.height,
+                                slide.title,
+                                slide.role,
+                                slide.extra_data,
+                                slide.theme,
+                                self.text_styles,
+                                slide.element,
+                                measurements)
+
+
+class PdftkMerger:
+
+    # The same interface as PdfMerger; pdftk joins all pages at the end
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.filenames = []
+        self.tmp_dir = None
+
+    def append(self, filename):
+        self.filenames.append(filename)
+
+    def append_data(self, data):
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.mkdtemp(prefix="elphie-")
+        filename = os.path.join(
+            self.tmp_dir, "{}.pdf".format(len(self.filenames)))
+        with open(filename, "wb") as f:
+            f.write(data)
+        self.append(filename)
+
+    def close(self):
+        args = ["pdftk"] + self.filenames + ["cat", "output", self.filename]
+        try:
+            with tracer.span("pdftk", "subprocess",
+                             pages=len(self.filenames)):
+                if subprocess.call(args) != 0:
+                    raise Exception("pdftk failed")
+        finally:
+            self.discard()
+
+    def discard(self):
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir)
+            self.tmp_dir = None
+
+
+# Number of pages per thread that are built or converted at once
+BUILD_WINDOW = 2
+
+_worker_builder = None
+
+
+def _get_result(value):
+    if isinstance(value, str):
+        return value
+    return value.result()
+
+
+def _init_worker(builder, trace_origin):
+    global _worker_builder
+    _worker_builder = builder
+    if trace_origin is not None:
+        tracer.enable(trace_origin)
+
+
+def _build_steps_in_worker(task):
+    # Spans recorded in the worker are sent back with the result
+    return _worker_builder.build_steps(*task), tracer.take_events()
+
+
+def _get_text_content(text):
+    return "".join(value if token == "text" else "\n" * value
+                   for token, value in text
+                   if token in ("text", "newline"))
+
+
+def _step_name(index, step):
+    return "Slide {} step {}".format(index + 1, step)
+
+
+def _map_bounded(executor, fn, items, window):
+    # Like executor.map, but submits at most 'window' items ahead of
+    # the consumer, so results do not pile up in memory
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
 class Slides:
 
     def __init__(self,
@@ -80,7 +306,20 @@ class Slides:
                  cache_dir="./elphie-cache",
                  parse_args=True,
                  debug=False,
-                 threads=None):
+                 threads=None,
+                 query_batch_size=None,
+                 inkscape_workers=None,
+                 query_engine="inkscape",
+                 metrics_tolerance=0.02,
+                 executor="thread",
+                 merger="builtin",
+                 renderer="svg",
+                 cache_backend="directory",
+                 cache_generations=1,
+                 cache_max_size=None,
+                 cache_max_age=None,
+                 cache_report=False,
+                 trace=None):
         self.filename = filename
         self.slides = []
         if theme:
@@ -93,6 +332,28 @@ class Slides:
         self.user_defined_text_styles = {}
         self.debug = debug
         self.threads = threads
+        self.query_batch_size = query_batch_size
+        self.inkscape_workers = inkscape_workers
+        self.inkscape_pool = None
+        self.query_engine = query_engine
+        self.metrics_tolerance = metrics_tolerance
+        self.executor = executor
+        self.merger = merger
+        self.renderer = renderer
+        self.cache_backend = cache_backend
+        self.cache_generations = cache_generations
+        # Bytes and seconds
+        self.cache_max_size = cache_max_size
+        self.cache_max_age = cache_max_age
+        self.cache_report = cache_report
+        # Prefix of files with the timeline and the summary of the build
+        self.trace = trace
+        self.cache = None
+        # PDF conversions started in this run, by the target filename
+        self.conversions = {}
+        # Names of image blobs used by conversions in this run
+        self.images = set()
+        self.conversions_lock = threading.Lock()
 
         if parse_args:
             self._parse_args()
@@ -137,133 +398,422 @@ class Slides:
     def render(self):
         if not os.path.isdir(self.cache_dir):
             print("Creating cache directory: ", self.cache_dir)
-            os.makedirs(self.cache_dir)
+            os.makedirs(self.cache_dir, exist_ok=True)
 
         if not self.slides:
             raise Exception("No slides to render")
 
+        if self.trace:
+            tracer.enable()
+        self.cache = self._open_cache()
+        try:
+            # Other decks may be built against the same cache at once
+            with tracer.span("Waiting for cache", "phase"):
+                self.cache.lock_build()
+            try:
+                filenames = self._render()
+                query_keys = set(key for slide in self.slides
+                                 for key in slide.query_keys)
+                self.cache.record_build(self.filename,
+                                        filenames + sorted(self.images),
+                                        {"queries": query_keys})
+            finally:
+                self.cache.unlock_build()
+
+            # Clean old cached files
+            with tracer.span("Collecting garbage", "phase") as span:
+                removed = self.cache.collect_garbage(
+                    GarbagePolicy(self.cache_generations,
+                                  self.cache_max_size,
+                                  self.cache_max_age),
+                    stores=("queries",))
+                span.set("removed", removed)
+            if self.cache_report:
+                print(self.cache.get_manifest().get_report())
+        finally:
+            self.cache.close()
+            self.cache = None
+            if self.trace:
+                self._write_trace()
+                tracer.disable()
+
+    def _write_trace(self):
+        summary = tracer.get_summary([slide.title for slide in self.slides])
+        tracer.write_summary(self.trace + ".summary.json", summary)
+        tracer.write_chrome_trace(self.trace + ".trace.json")
+        print(tracer.format_summary(summary))
+
+    def _open_cache(self):
+        backend = CACHE_BACKENDS.get(self.cache_backend)
+        if backend is None:
+            raise Exception(
+                "Invalid cache backend: '{}'".format(self.cache_backend))
+        return backend(self.cache_dir)
+
+    def _render(self):
+        # Returns names of PDF blobs in the cache that form the deck
+        with contextlib.ExitStack() as cleanup:
+            return self._build_deck(cleanup)
+
+    def _build_deck(self, cleanup):
+        # Everything opened here is closed by 'cleanup', also on errors
+
+        # Sizes and steps of images are known without parsing them
+        image_store.open_metadata(self.cache.open_store("image-metadata"))
+        cleanup.callback(image_store.close_metadata)
+
         # Gather slide queries
-        renderer = RendererSVG()
+        query_engine = self._make_query_engine()
+        query_sources = {} if self.debug else None
+        renderer = RendererSVG(query_engine, query_sources)
         queries = []
-        old_query_cache = self._load_query_cache()
+        query_store = self.cache.open_store("queries")
+        cleanup.callback(query_store.close)
         query_cache = {}
 
-        for slide in self.slides:
-            ctx = Context(renderer, slide.theme, slide, None, None,
-                          self.user_defined_text_styles)
-            for query in slide.gather_queries(ctx):
-                key = query[0]
-                value = old_query_cache.get(key)
-                if value is not None:
-                    query_cache[key] = value
-                else:
-                    queries.append(query)
-        queries = dict(queries)
-
-        # Create threads
+        with tracer.span("Gathering queries", "phase"):
+            for slide in self.slides:
+                ctx = Context(renderer, slide.theme, slide, None, None,
+                              self.user_defined_text_styles)
+                slide_queries = slide.gather_queries(ctx)
+                slide.query_keys = [query[0] for query in slide_queries]
+                for query in slide_queries:
+                    key = query[0]
+                    value = query_store.get(key)
+                    if value is not None:
+                        query_cache[key] = value
+                    else:
+                        queries.append(query)
+            queries = dict(queries)
+        tracer.count("query_cache_hits", len(query_cache))
+        tracer.count("query_cache_misses", len(queries))
+        if query_sources is not None:
+            self._write_query_sources(query_sources)
+
+        # Create threads; measuring and building have separate pools,
+        # so building of a slide does not wait behind queries of others
         threads = self.threads
         if threads is None:
             threads = os.cpu_count() or 1
+        query_pool = ThreadPoolExecutor(threads)
+        cleanup.callback(query_pool.shutdown)
+        if self.inkscape_workers:
+            self.inkscape_pool = InkscapePool(self.inkscape_workers)
+            cleanup.callback(self._close_inkscape_pool)
         pool = ThreadPoolExecutor(threads)
-
-        # Process new queries
-        self._show_progress("Preprocessing", first=True)
-        count = 0
-        for key, result in pool.map(
-                lambda query: (query[0], query[1]()), queries.items()):
-            query_cache[key] = result
-            count += 1
-            self._show_progress("Preprocessing", count, len(queries))
-        self._show_progress("Preprocessing", count, len(queries), last=True)
-        self._save_query_cache(query_cache)
-
-        # Create context of uncached slides
-        cached_pdf = self._get_cached_pdf()
-        contexts = []
-        for i, slide in enumerate(self.slides):
-            for step in range(slide.get_max_step()):
-                renderer = RendererSVG()
-                renderer.begin(self.width, self.height)
-                ctx = Context(
-                    renderer, slide.theme, slide, step + 1, query_cache,
-                    self.user_defined_text_styles)
-                contexts.append(ctx)
-
-        # Build uncached slides
+        cleanup.callback(pool.shutdown)
+
+        # New queries are processed in the background; each slide is
+        # built as soon as its own queries are finished
+        query_futures = {}
+        for items in self._make_query_jobs(queries, threads):
+            future = query_pool.submit(self._run_queries, query_engine,
+                                       items, query_store)
+            for key, query in items:
+                query_futures[key] = future
+
+        def wait_for_queries(keys):
+            for key in keys:
+                future = query_futures.pop(key, None)
+                if future is not None:
+                    with tracer.span("Waiting for queries", "wait"):
+                        results = future.result()
+                    for result_key, result in results:
+                        query_cache[result_key] = result
+                        query_futures.pop(result_key, None)
+
+        # Steps whose fingerprint maps to an existing PDF are not built
+        builder = SlideBuilder(self.slides, self.width, self.height,
+                               self.user_defined_text_styles, query_cache,
+                               self.cache_dir if self.debug else None,
+                               self.renderer)
+        fingerprints = self.cache.open_store("fingerprints")
+        cleanup.callback(fingerprints.close)
+        pages = []
+        self.conversions = {}
+        self.images = set()
+
+        def make_jobs():
+            # Each distinct state of a slide is built once, from its first
+            # step; pages refer to indices of jobs
+            job_count = 0
+            for index, slide in enumerate(self.slides):
+                wait_for_queries(slide.query_keys)
+                with tracer.span("fingerprint", "fingerprint", slide=index):
+                    slide_fingerprint = builder.get_fingerprint(slide)
+                slide_jobs = {}
+                for step, state in enumerate(slide.get_step_states(), 1):
+                    job = slide_jobs.get(state)
+                    if job is None:
+                        fingerprint = make_fingerprint(
+                            slide_fingerprint, state)
+                        filename = fingerprints.get(fingerprint)
+                        if filename is not None and (
+                                self.debug or
+                                not self.cache.has_blob(filename)):
+                            filename = None
+                        if filename is None:
+                            tracer.count("page_cache_misses")
+                        else:
+                            tracer.count("page_cache_hits")
+                        job = job_count
+                        job_count += 1
+                        slide_jobs[state] = job
+                        yield (index, step, fingerprint, filename)
+                    pages.append(job)
+
+        page_count = sum(slide.get_max_step() for slide in self.slides)
         self._show_progress("Building", first=True)
         filenames = []
-        count = 0
-        for filename in pool.map(
-                lambda ctx: self.render_slide(ctx, cached_pdf),
-                contexts):
-            filenames.append(filename)
-            count += 1
-            self._show_progress("Building", count, len(contexts))
-        self._show_progress("Building", count, len(contexts), last=True)
-
-        # Clean old cached files
-        if not self.debug:
-            for filename in set(cached_pdf) - set(filenames):
-                os.remove(os.path.join(self.cache_dir, filename))
-
-        # Join everything into one file
-        self._show_progress("Creating '{}'".format(self.filename), first=True)
-        args = ["pdftk"]
-        args += [os.path.join(self.cache_dir, filename)
-                 for filename in filenames]
-        args += ["cat", "output", self.filename]
-        subprocess.call(args)
-        self._show_progress("Creating '{}'".format(self.filename), last=True)
+        last_index = None
+        # The previous deck is replaced only by a complete output
+        output_filename = "{}.{}.tmp".format(self.filename, os.getpid())
+        output = self._open_output(output_filename)
+        cleanup.callback(self._discard_output, output, output_filename)
+        written = 0
+        # Pages go to the output in order as soon as they are ready
+        with tracer.span("Building", "phase", pages=page_count):
+            for job, filename in self._build_slides(
+                    builder, pool, threads, make_jobs()):
+                # Jobs finish in order, so earlier slides are done
+                if last_index is not None and last_index != job[0]:
+                    builder.release(self.slides[last_index])
+                last_index = job[0]
+                fingerprint = job[2]
+                if job[3] is None:
+                    fingerprints.put_many(((fingerprint, filename),))
+                filenames.append(filename)
+                while written < len(pages) and \
+                        pages[written] < len(filenames):
+                    output.append_data(
+                        self.cache.read_blob(filenames[pages[written]]))
+                    written += 1
+                self._show_progress("Building", written, page_count)
+        self._show_progress("Building", written, page_count, last=True)
+
+        self._show_progress("Creating '{}'".format(self.filename),
+                            first=True)
+        with tracer.span("Creating output", "phase"):
+            output.close()
+            os.replace(output_filename, self.filename)
+        if tracer.enabled:
+            tracer.count("output_bytes", os.path.getsize(self.filename))
+        self._show_progress("Creating '{}'".format(self.filename),
+                            last=True)
+
+        # Queries are compacted by garbage collection, which knows
+        # keys used by other decks sharing the cache
+        wait_for_queries(list(query_futures))
+        with tracer.span("Compacting cache", "phase"):
+            live_fingerprints = [
+                key for key, filename in fingerprints.items()
+                if self.cache.has_blob(filename)]
+            if fingerprints.needs_compaction(live_fingerprints):
+                fingerprints.compact(live_fingerprints)
+        self._report_metrics_mismatches(query_engine)
+        return filenames
+
+    def _discard_output(self, output, filename):
+        output.discard()
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def _close_inkscape_pool(self):
+        self.inkscape_pool.close()
+        self.inkscape_pool = None
+
+    def _make_query_jobs(self, queries, threads):
+        items = list(queries.items())
+        if not self.query_batch_size:
+            return [[item] for item in items]
+        # Spread queries over all threads, but never exceed the batch size
+        size = min(self.query_batch_size,
+                   max(1, (len(items) + threads - 1) // threads))
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    def _run_queries(self, query_engine, items, query_store):
+        with tracer.span("measure", "query", texts=len(items)):
+            results = query_engine.compute([query for key, query in items])
+        results = [(key, result)
+                   for (key, query), result in zip(items, results)]
+        # Stored at once, so measurements survive a failed build
+        query_store.put_many(results)
+        return results
+
+    def _make_query_engine(self):
+        if self.query_engine == "inkscape":
+            return InkscapeQueryEngine()
+        if self.query_engine == "fontmetrics":
+            return FontMetricsEngine(InkscapeQueryEngine())
+        if self.query_engine == "verify":
+            return FontMetricsEngine(InkscapeQueryEngine(),
+                                     verify=True,
+                                     tolerance=self.metrics_tolerance)
+        raise Exception(
+            "Invalid query engine: '{}'".format(self.query_engine))
+
+    def _report_metrics_mismatches(self, query_engine):
+        mismatches = getattr(query_engine, "mismatches", None)
+        if not mismatches:
+            return
+        print("Font metrics differ from Inkscape in {} text(s):".format(
+            len(mismatches)))
+        for text, expected, width in mismatches:
+            print("  inkscape={:.2f} fontmetrics={:.2f} {!r}".format(
+                expected, width, _get_text_content(text)))
 
     def set_style(self, name, style):
         assert isinstance(name, str)
         assert isinstance(style, TextStyle)
         self.user_defined_text_styles[name] = style
 
-    def convert_to_pdf(self, source, target):
-        run_inkscape(("-A", target), stdin=source)
-
-    def render_slide(self, ctx, cached_pdf):
-        ctx.renderer.begin(self.width, self.height)
-        ctx.theme.render_slide(ctx)
-        ctx.renderer.end()
+    def _open_output(self, filename):
+        if self.merger == "builtin":
+            return PdfMerger(filename)
+        elif self.merger == "pdftk":
+            return PdftkMerger(filename)
+        else:
+            raise Exception("Invalid merger: '{}'".format(self.merger))
 
-        if self.debug:
-            filename = os.path.join(self.cache_dir, "slide-{}-{}.svg".format(
-                self.slides.index(ctx.slide), ctx.step))
-            ctx.renderer.write(filename)
+    def convert_to_pdf(self, source, target):
+        if self.renderer == "pdf":
+            write_pdf(source, target, self._convert_image)
+        elif self.inkscape_pool:
+            self.inkscape_pool.convert(source, target)
+        else:
+            run_inkscape(("-A", target), stdin=source)
+
+    def _convert_image(self, svg):
+        # Rasterised images are blobs recorded with the build, so garbage
+        # collection and size limits apply to them as to pages
+        filename = "{}-{}.png".format(
+            hashlib.sha1(svg.encode()).hexdigest(), IMAGE_DPI)
+        with self.conversions_lock:
+            self.images.add(filename)
+        if not self.cache.has_blob(filename):
+            tmp_filename = "{}.{}-{}.tmp".format(
+                os.path.join(self.cache_dir, filename),
+                os.getpid(), threading.get_ident())
+            run_inkscape(("-e", tmp_filename, "-d", str(IMAGE_DPI)),
+                         stdin=svg)
+            self.cache.write_blob(filename, tmp_filename)
+        return io.BytesIO(self.cache.read_blob(filename))
+
+    def make_pdf(self, data):
+        filename = hashlib.sha1(data).hexdigest() + ".pdf"
+        if self.cache.has_blob(filename):
+            return filename
+
+        # Pages with the same content are converted only once; others
+        # wait for the running conversion
+        with self.conversions_lock:
+            future = self.conversions.get(filename)
+            if future is None:
+                future = Future()
+                self.conversions[filename] = future
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            tracer.count("conversions_shared")
+            return future.result()
 
-        string = ctx.renderer.to_string()
-        h = hashlib.sha1()
-        h.update(string.encode())
-        filename = h.hexdigest() + ".pdf"
-        if filename not in cached_pdf:
+        try:
             full_filename = os.path.join(self.cache_dir, filename)
-            self.convert_to_pdf(ctx.renderer.to_string(), full_filename)
+            tmp_filename = "{}.{}-{}.tmp".format(
+                full_filename, os.getpid(), threading.get_ident())
+            with tracer.span("convert", "convert", bytes=len(data)):
+                self.convert_to_pdf(data, tmp_filename)
+            tracer.count("conversions")
+            if tracer.enabled:
+                tracer.count("cache_bytes_written",
+                             os.path.getsize(tmp_filename))
+            self.cache.write_blob(filename, tmp_filename)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        future.set_result(filename)
         return filename
 
-    def _load_query_cache(self):
-        filename = os.path.join(self.cache_dir, "queries")
-        try:
-            with open(filename, "rb") as f:
-                query_cache = pickle.load(f)
-                print("Cache loaded")
-                return query_cache
-        except FileNotFoundError:  # noqa
-            print("No cache file found")
-            return {}
-
-    def _save_query_cache(self, query_cache):
-        filename = os.path.join(self.cache_dir, "queries")
-        try:
-            with open(filename, "wb") as f:
-                pickle.dump(query_cache, f)
-        except:
-            print("Cache cannot be written")
+    def _build_slides(self, builder, pool, processes, jobs):
+        # Yields pairs (job, PDF filename) in the order of jobs; only
+        # a few pages per thread are held in memory at once
+        window = processes * BUILD_WINDOW
+        # Workers are forked, so a deck script without the __main__ guard
+        # is not executed again in them
+        kind = self.executor
+        if kind == "process" and \
+                "fork" not in multiprocessing.get_all_start_methods():
+            print("Building in processes needs the 'fork' start method, "
+                  "threads are used instead")
+            kind = "thread"
+        if kind == "thread":
+            def build(job):
+                index, step, fingerprint, filename = job
+                if filename is None:
+                    with tracer.span(_step_name(index, step), "step",
+                                     slide=index, step=step):
+                        ctx = builder.make_context(self.slides[index], step)
+                        data = builder.build(ctx)
+                        tracer.count("page_source_bytes", len(data))
+                        filename = self.make_pdf(data)
+                return job, filename
+            yield from _map_bounded(pool, build, jobs, window)
+        elif kind == "process":
+            # Layout and SVG generation run in worker processes,
+            # conversions to PDF are started from threads. Workers get
+            # a copy of the builder, so all queries have to be finished
+            jobs = list(jobs)
+            tasks = {}
+            for index, step, fingerprint, filename in jobs:
+                if filename is None:
+                    tasks.setdefault(index, []).append(step)
+            pending = deque()
+
+            def collect(results):
+                for svgs, events in results:
+                    tracer.add_events(events)
+                    yield from svgs
+
+            def convert(job, data):
+                index, step = job[:2]
+                with tracer.span(_step_name(index, step), "step",
+                                 slide=index, step=step):
+                    return self.make_pdf(data)
+
+            trace_origin = tracer.origin if tracer.enabled else None
+            context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(processes,
+                                     mp_context=context,
+                                     initializer=_init_worker,
+                                     initargs=(builder, trace_origin)) \
+                    as executor:
+                svgs = collect(
+                    _map_bounded(executor, _build_steps_in_worker,
+                                 sorted(tasks.items()), processes))
+                for job in jobs:
+                    filename = job[3]
+                    if filename is None:
+                        data = next(svgs)
+                        tracer.count("page_source_bytes", len(data))
+                        filename = pool.submit(convert, job, data)
+                    pending.append((job, filename))
+                    while pending and (len(pending) > window or
+                                       isinstance(pending[0][1], str) or
+                                       pending[0][1].done()):
+                        job, filename = pending.popleft()
+                        yield job, _get_result(filename)
+            while pending:
+                job, filename = pending.popleft()
+                yield job, _get_result(filename)
+        else:
+            raise Exception("Invalid executor: '{}'".format(self.executor))
 
-    def _get_cached_pdf(self):
-        return [filename for filename in os.listdir(self.cache_dir)
-                if filename.endswith(".pdf")]
+    def _write_query_sources(self, query_sources):
+        filename = os.path.join(self.cache_dir, "query-sources.txt")
+        with open(filename, "w") as f:
+            for key, text in query_sources.items():
+                f.write("{} {!r}\n".format(key.hex(), text))
 
     def _parse_args(self):
         parser = argparse.ArgumentParser(description="Elphie")
@@ -276,6 +826,92 @@ class Slides:
                             default=self.threads,
                             help="Number of used threads "
                                  "(default: autodetect)")
+        parser.add_argument("--query-batch",
+                            type=int,
+                            default=self.query_batch_size,
+                            metavar="SIZE",
+                            help="Measure up to SIZE texts in one Inkscape "
+                                 "call (default: one call per text)")
+        parser.add_argument("--inkscape-workers",
+                            type=int,
+                            default=self.inkscape_workers,
+                            metavar="N",
+                            help="Convert slides by N long-running Inkscape "
+                                 "processes (default: one process per "
+                                 "slide)")
+        parser.add_argument("--query-engine",
+                            choices=("inkscape", "fontmetrics", "verify"),
+                            default=self.query_engine,
+                            help="How texts are measured; 'verify' compares "
+                                 "font metrics against Inkscape")
+        parser.add_argument("--metrics-tolerance",
+                            type=float,
+                            default=self.metrics_tolerance,
+                            help="Relative width difference reported in "
+                                 "the verify mode (default: %(default)s)")
+        parser.add_argument("--executor",
+                            choices=("thread", "process"),
+                            default=self.executor,
+                            help="Build slides in threads or in separate "
+                                 "processes (default: %(default)s)")
+        parser.add_argument("--merger",
+                            choices=("builtin", "pdftk"),
+                            default=self.merger,
+                            help="How pages are joined into the final PDF "
+                                 "(default: %(default)s)")
+        parser.add_argument("--renderer",
+                            choices=("svg", "pdf"),
+                            default=self.renderer,
+                            help="Convert pages from SVG by Inkscape or "
+                                 "draw PDF directly through cairo "
+                                 "(default: %(default)s)")
+        parser.add_argument("--cache-backend",
+                            choices=sorted(CACHE_BACKENDS),
+                            default=self.cache_backend,
+                            help="How the cache directory is stored "
+                                 "(default: %(default)s)")
+        parser.add_argument("--cache-generations",
+                            type=int,
+                            default=self.cache_generations,
+                            metavar="N",
+                            help="Keep pages of the last N builds of each "
+                                 "deck (default: %(default)s)")
+        parser.add_argument("--cache-max-size",
+                            type=parse_size,
+                            default=self.cache_max_size,
+                            metavar="SIZE",
+                            help="Evict least recently used pages above "
+                                 "SIZE bytes; K, M and G suffixes are "
+                                 "allowed")
+        parser.add_argument("--cache-max-age",
+                            type=float,
+                            default=None,
+                            metavar="DAYS",
+                            help="Evict pages and builds older than DAYS")
+        parser.add_argument("--cache-report",
+                            action="store_true",
+                            default=self.cache_report,
+                            help="Show how much of the cache each deck uses")
+        parser.add_argument("--trace",
+                            default=self.trace,
+                            metavar="PREFIX",
+                            help="Write a timeline of the build to "
+                                 "PREFIX.trace.json (for chrome://tracing) "
+                                 "and a summary to PREFIX.summary.json")
         args = parser.parse_args()
         self.debug = args.debug
         self.threads = args.threads
+        self.query_batch_size = args.query_batch
+        self.inkscape_workers = args.inkscape_workers
+        self.query_engine = args.query_engine
+        self.metrics_tolerance = args.metrics_tolerance
+        self.executor = args.executor
+        self.merger = args.merger
+        self.renderer = args.renderer
+        self.cache_backend = args.cache_backend
+        self.cache_generations = args.cache_generations
+        self.cache_max_size = args.cache_max_size
+        if args.cache_max_age is not None:
+            self.cache_max_age = args.cache_max_age * 24 * 3600
+        self.cache_report = args.cache_report
+        self.trace = args.trace
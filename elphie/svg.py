@@ -1,12 +1,50 @@
-from elphie.sxml import Xml
+from elphie.sxml import Xml, format_attribute
+from elphie.trace import tracer
 
 import lxml.etree as et
+from functools import lru_cache
+import hashlib
 import subprocess
 
 
-class RendererSVG:
+class Renderer:
 
-    def __init__(self):
+    # Text measurement shared by all renderers
+
+    def __init__(self, query_engine=None, query_sources=None):
+        if query_engine is None:
+            query_engine = InkscapeQueryEngine()
+        self.query_engine = query_engine
+        # Optional mapping from query keys to measured texts (for debugging)
+        self.query_sources = query_sources
+
+    def get_text_size_query_key(self, style, styles, text):
+        description = ["textsize", _style_description(style)]
+        for token_type, value in text:
+            if token_type == "begin":
+                value = _style_description(styles[value])
+            description.append((token_type, value))
+        key = hashlib.sha1(repr(description).encode()).digest()
+        if self.query_sources is not None:
+            self.query_sources[key] = text
+        return key
+
+    def get_text_size_query(self, style, styles, text):
+        key = self.get_text_size_query_key(style, styles, text)
+        # Measure without colors and alignment, so the result depends
+        # only on what the key describes
+        used_styles = dict((value, styles[value].metrics_only())
+                           for token_type, value in text
+                           if token_type == "begin")
+        return key, TextSizeQuery(style.metrics_only(), used_styles, text)
+
+
+class RendererSVG(Renderer):
+
+    debug_suffix = ".svg"
+
+    def __init__(self, query_engine=None, query_sources=None):
+        super().__init__(query_engine, query_sources)
         self.xml = None
 
     def begin(self, width, height):
@@ -54,36 +92,26 @@ class RendererSVG:
         xml.set("style", ";".join(style))
         xml.close()
 
+    def begin_fragment(self):
+        return self.xml.mark()
+
+    def end_fragment(self, mark):
+        return self.xml.join_since(mark)
+
+    def draw_fragment(self, fragment):
+        self.xml.raw_text(fragment)
+
     def write(self, filename):
         self.xml.write(filename)
 
     def to_string(self):
         return self.xml.to_string()
 
-    def get_text_size_query_key(self, style, styles, text):
-        xml = Xml()
-        xml.element("svg")
-        render_text(xml, 0, 0, text, style, styles, id="t1")
-        xml.close()
-        self.svg = xml.to_string()
-        self.style = style
-        return ("textsize", self.svg)
-
-    def get_text_size_query(self, style, styles, text):
-        key = self.get_text_size_query_key(style, styles, text)
-        svg = key[1]
-
-        def compute():
-            width = float(run_inkscape(("--query-id=t1", "-W"), None, svg))
-            line_height = style.size * style.line_spacing
-            lines = 1
-            for (token, value) in text:
-                if token == "newline":
-                    lines += value
-            height = lines * line_height
-            return width, height
+    def to_bytes(self):
+        return self.xml.to_bytes()
 
-        return key, compute
+    def clear(self):
+        self.xml = None
 
     def draw_image(self, svgstring, x, y, scale=1.0):
         self.xml.element("g")
@@ -101,20 +129,111 @@ class RendererSVG:
         return width, height
 
 
+class TextSizeQuery:
+
+    def __init__(self, style, styles, text):
+        self.style = style
+        self.styles = styles
+        self.text = text
+
+    def get_height(self):
+        line_height = self.style.size * self.style.line_spacing
+        lines = 1
+        for (token, value) in self.text:
+            if token == "newline":
+                lines += value
+        return lines * line_height
+
+    def __call__(self):
+        xml = Xml()
+        xml.element("svg")
+        render_text(xml, 0, 0, self.text, self.style, self.styles, id="t1")
+        xml.close()
+        svg = xml.to_string()
+        width = float(run_inkscape(("--query-id=t1", "-W"), None, svg))
+        return width, self.get_height()
+
+
+def run_text_size_queries(queries):
+    if len(queries) == 1:
+        return [queries[0]()]
+
+    xml = Xml()
+    xml.element("svg")
+    for i, query in enumerate(queries):
+        render_text(xml, 0, 0, query.text, query.style, query.styles,
+                    id="t{}".format(i))
+    xml.close()
+
+    output = run_inkscape(("--query-all",), None, xml.to_string())
+    widths = parse_query_all(output, len(queries))
+    return [(width, query.get_height())
+            for width, query in zip(widths, queries)]
+
+
+def parse_query_all(output, count):
+    # Returns widths of elements t0 ... t{count - 1}
+    widths = {}
+    for line in output.decode().splitlines():
+        parts = line.split(",")
+        if len(parts) == 5:
+            widths[parts[0]] = float(parts[3])
+    result = []
+    for i in range(count):
+        width = widths.get("t{}".format(i))
+        if width is None:
+            raise Exception(
+                "Inkscape did not measure text 't{}'".format(i))
+        result.append(width)
+    return result
+
+
+class InkscapeQueryEngine:
+
+    def compute(self, queries):
+        return run_text_size_queries(queries)
+
+
+def _style_description(style):
+    return (style.font,
+            style.size,
+            style.line_spacing,
+            bool(style.bold),
+            bool(style.italic))
+
+
+_PRESERVE_SPACE = format_attribute("xml:space", "preserve")
+
+
 def set_font_from_style(xml, style):
-    if style.font:
-        xml.set("font-family", style.font)
-    if style.size:
-        xml.set("font-size", style.size)
+    attributes = _format_font_attributes(
+        style.font, style.size, style.color, style.bold, style.italic)
+    if attributes:
+        xml.set_formatted(attributes)
+
+
+def _get_tspan_attributes(style):
+    return _PRESERVE_SPACE + _format_font_attributes(
+        style.font, style.size, style.color, style.bold, style.italic)
+
+
+@lru_cache(maxsize=1024, typed=True)
+def _format_font_attributes(font, size, color, bold, italic):
+    attributes = ""
+    if font:
+        attributes += format_attribute("font-family", font)
+    if size:
+        attributes += format_attribute("font-size", size)
     s = ""
-    if style.color:
-        s += "fill:{};".format(style.color)
-    if style.bold:
+    if color:
+        s += "fill:{};".format(color)
+    if bold:
         s += "font-weight: bold;"
-    if style.italic:
+    if italic:
         s += "font-style: italic;"
     if s:
-        xml.set("style", s)
+        attributes += format_attribute("style", s)
+    return attributes
 
 
 def render_text(xml, x, y, parsed_text, style, styles, id=None):
@@ -137,35 +256,38 @@ def render_text(xml, x, y, parsed_text, style, styles, id=None):
     set_font_from_style(xml, style)
     line_size = style.size * style.line_spacing
     active_styles = [style]
+    element = xml.element
+    close = xml.close
     xml.element("tspan")
     for token_type, value in parsed_text:
         if token_type == "text":
             xml.text(value)
         elif token_type == "newline":
             for s in active_styles:
-                xml.close()  # tspan
+                close()  # tspan
             for i, s in enumerate(active_styles):
-                xml.element("tspan")
-                xml.set("xml:space", "preserve")
+                element("tspan")
                 if i == 0:
+                    xml.set_formatted(_PRESERVE_SPACE)
                     xml.set("x", x)
                     xml.set("dy", line_size * value)
-                set_font_from_style(xml, s)
+                    set_font_from_style(xml, s)
+                else:
+                    xml.set_formatted(_get_tspan_attributes(s))
         elif token_type == "begin":
             s = styles[value]
             active_styles.append(s)
-            xml.element("tspan")
-            xml.set("xml:space", "preserve")
-            set_font_from_style(xml, s)
+            element("tspan")
+            xml.set_formatted(_get_tspan_attributes(s))
         elif token_type == "end":
-            xml.close()
+            close()
             active_styles.pop()
         else:
             raise Exception("Invalid token")
 
     for s in active_styles:
-        xml.close()  # tspan
-    xml.close("text")  # text
+        close()  # tspan
+    close("text")  # text
 
 
 def run_inkscape(extra_args, filename=None, stdin=None):
@@ -178,7 +300,11 @@ def run_inkscape(extra_args, filename=None, stdin=None):
                              stdin=subprocess.PIPE,
                              stdout=subprocess.PIPE,
                              stderr=devnull)
-        stdout, stderr = p.communicate(stdin.encode("utf-8"))
+        if isinstance(stdin, str):
+            stdin = stdin.encode("utf-8")
+        with tracer.span("inkscape", "subprocess", args=" ".join(extra_args),
+                         bytes=len(stdin) if stdin else 0):
+            stdout, stderr = p.communicate(stdin)
         return stdout
 
 
@@ -1,3 +1,4 @@
+from functools import lru_cache
 
 
 class Xml:
@@ -16,23 +17,37 @@ class Xml:
         self._close()
         self.chunks.append(text)
 
-    def element(self, name):
+    def mark(self):
         self._close()
-        self.chunks.append("<")
-        self.chunks.append(name)
+        return len(self.chunks)
+
+    def join_since(self, mark):
+        # Joins chunks written after the mark into one string
+        assert not self.is_open
+        text = "".join(self.chunks[mark:])
+        self.chunks[mark:] = [text]
+        return text
+
+    def element(self, name):
+        if self.is_open:
+            self.chunks.append("><" + name)
+        else:
+            self.chunks.append("<" + name)
+            self.is_open = True
         self.stack.append(name)
-        self.is_open = True
 
     def set(self, name, value):
         assert self.is_open
-        value = str(value).replace("'", "\\'")
-        self.chunks.append(" {}='{}'".format(name, escape_text(value)))
+        self.chunks.append(format_attribute(name, value))
+
+    def set_formatted(self, attributes):
+        # Attributes from format_attribute(), e.g. prepared for reuse
+        assert self.is_open
+        self.chunks.append(attributes)
 
     def text(self, text):
         self._close()
-        text = escape_text(str(text))
-        text = text.replace(" ", "&#160;")
-        self.chunks.append(text)
+        self.chunks.append(_escape_text_content(str(text)))
 
     def close(self, text=None):
         assert self.stack, "At least one element has to be opened"
@@ -42,14 +57,16 @@ class Xml:
             self.stack.pop()
             self.chunks.append(" />")
         else:
-            self.chunks.append("</")
-            self.chunks.append(self.stack.pop())
-            self.chunks.append(">")
+            self.chunks.append(_end_tag(self.stack.pop()))
 
     def to_string(self):
         assert len(self.stack) == 0, "Empty stack"
         return "".join(self.chunks)
 
+    def to_bytes(self):
+        assert len(self.stack) == 0, "Empty stack"
+        return "".join(self.chunks).encode("utf-8")
+
     def write(self, filename):
         assert len(self.stack) == 0, "Empty stack"
         with open(filename, "w") as f:
@@ -57,6 +74,39 @@ class Xml:
                 f.write(chunk)
 
 
+def format_attribute(name, value):
+    value_type = type(value)
+    if value_type is int or value_type is float:
+        # Numbers need no escaping
+        value = str(value)
+    else:
+        value = _escape_attribute(str(value))
+    return _attribute_prefix(name) + value + "'"
+
+
+# Names of elements and attributes and most of values come from a small
+# set (styles, colors, tokens of code), so their escaped forms are cached
+
+@lru_cache(maxsize=None)
+def _attribute_prefix(name):
+    return " " + name + "='"
+
+
+@lru_cache(maxsize=None)
+def _end_tag(name):
+    return "</" + name + ">"
+
+
+@lru_cache(maxsize=4096, typed=True)
+def _escape_attribute(value):
+    return escape_text(value.replace("'", "\\'"))
+
+
+@lru_cache(maxsize=4096, typed=True)
+def _escape_text_content(text):
+    return escape_text(text).replace(" ", "&#160;")
+
+
 def escape_text(text):
     text = text.replace("&", "&amp;")
     text = text.replace("<", "&lt;")
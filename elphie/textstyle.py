@@ -20,6 +20,13 @@ class TextStyle:
                   "bold",
                   "italic")
 
+    # Attributes that can change the size of a text
+    metric_attributes = ("font",
+                         "size",
+                         "line_spacing",
+                         "bold",
+                         "italic")
+
     def __init__(self, **kwargs):
         for key in kwargs:
             assert key in self.attributes
@@ -28,6 +35,12 @@ class TextStyle:
     def copy(self):
         return copy(self)
 
+    def metrics_only(self):
+        style = TextStyle()
+        for a in self.metric_attributes:
+            setattr(style, a, getattr(self, a))
+        return style
+
     def __repr__(self):
         s = ["<TextStyle"]
         for a in self.attributes:
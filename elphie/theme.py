@@ -110,6 +110,16 @@ class Theme:
         self.main_title_style.align = "center"
         self.main_title_style.size = 60
 
+    def get_fingerprint_state(self):
+        # Colors are class attributes, so vars() is not enough
+        state = {}
+        for name in dir(self):
+            if not name.startswith("_"):
+                value = getattr(self, name)
+                if not callable(value):
+                    state[name] = value
+        return state
+
     def draw_text(self, ctx, x, y, text, style):
         if isinstance(text, str):
             text = parse_text(text)
@@ -291,7 +301,7 @@ class Theme:
     # Frame
 
     def get_frame_size_request(self, ctx, frame):
-        request = frame.box.get_size_request(ctx)
+        request = self._get_size_requests(ctx, (frame.box,))[0]
         width, height = self._get_text_size(ctx, frame.title, "frame_title")
         request = request.ensure(width, 0)
         return request.resize(20, height + 20)
@@ -333,11 +343,21 @@ class Theme:
 
     # Elements helping functions
 
+    def _get_size_request(self, ctx, element):
+        # Sizes do not depend on the step, so each subtree is measured
+        # once per slide in each style context
+        key = (element,) + tuple(ctx.stack)
+        request = ctx.layout.size_requests.get(key)
+        if request is None:
+            request = element.get_size_request(ctx)
+            ctx.layout.size_requests[key] = request
+        return request
+
     def _get_size_requests(self, ctx, elements):
         results = []
         for e in elements:
             ctx.push(e)
-            results.append(e.get_size_request(ctx))
+            results.append(self._get_size_request(ctx, e))
             ctx.pop()
         return results
 
@@ -356,6 +376,30 @@ class Theme:
 
     def _make_rects_vertical(
             self, ctx, rect, elements, padding, fill_x, callback_fn):
+        rects = self._get_layout_rects(
+            ctx, self._compute_rects_vertical, rect, elements, padding, fill_x)
+        for e, r in zip(elements, rects):
+            callback_fn(e, r)
+
+    def _make_rects_horizontal(
+            self, ctx, rect, elements, padding, fill_y, callback_fn):
+        rects = self._get_layout_rects(
+            ctx, self._compute_rects_horizontal, rect, elements, padding,
+            fill_y)
+        for e, r in zip(elements, rects):
+            callback_fn(e, r)
+
+    def _get_layout_rects(self, ctx, compute_fn, rect, elements, *args):
+        # Rects do not depend on the step, they are computed once per slide
+        key = (compute_fn.__name__, rect.x, rect.y, rect.width, rect.height) \
+            + args + tuple(elements) + tuple(ctx.stack)
+        rects = ctx.layout.rects.get(key)
+        if rects is None:
+            rects = compute_fn(ctx, rect, elements, *args)
+            ctx.layout.rects[key] = rects
+        return rects
+
+    def _compute_rects_vertical(self, ctx, rect, elements, padding, fill_x):
         requests = self._get_size_requests(ctx, elements)
         height = sum(rq.height for rq in requests) + len(elements) * padding
         fill_y = sum(rq.fill_y for rq in requests)
@@ -363,7 +407,7 @@ class Theme:
         assert fill_y == 0
 
         y = rect.y + (rect.height - height) / 2.0
-        for rq, e in zip(requests, elements):
+        for rq in requests:
             if rq.fill_x or fill_x:
                 w = rect.width
                 x = rect.x
@@ -371,19 +415,19 @@ class Theme:
                 w = rq.width
                 x = rect.x + (rect.width - rq.width) / 2.0
             h = rq.height
-            callback_fn(e, Rect(x, y, w, h))
+            results.append(Rect(x, y, w, h))
             y += h + padding
         return results
 
-    def _make_rects_horizontal(
-            self, ctx, rect, elements, padding, fill_y, callback_fn):
+    def _compute_rects_horizontal(
+            self, ctx, rect, elements, padding, fill_y):
         requests = self._get_size_requests(ctx, elements)
         width = sum(rq.width for rq in requests) + len(elements) * padding
         fill_x = sum(rq.fill_x for rq in requests)
         results = []
         assert fill_x == 0
         x = rect.x + (rect.width - width) / 2.0
-        for rq, e in zip(requests, elements):
+        for rq in requests:
             if rq.fill_y or fill_y:
                 h = rect.height
                 y = rect.y
@@ -391,7 +435,7 @@ class Theme:
                 h = rq.height
                 y = rect.y + (rect.height - rq.height) / 2.0
             w = rq.width
-            callback_fn(e, Rect(x, y, w, h))
+            results.append(Rect(x, y, w, h))
             x += w + padding
         return results
 
@@ -401,7 +445,7 @@ class Theme:
         style = self._get_text_style(ctx, role)
         key = ctx.renderer.get_text_size_query_key(
             style, ctx.text_styles, text)
-        width, height = ctx.get_query(key)
+        width, height = ctx.get_query(key, text, style)
         offset_x, offset_y = self.get_text_offset(style)
         return width + offset_x * 2, height + offset_y * 2
 
@@ -424,6 +468,14 @@ class Theme:
                     ctx.renderer.draw_rect(r, color)
 
     def _get_text_style(self, ctx, role):
+        key = (role,) + tuple(ctx.stack)
+        style = ctx.layout.text_styles.get(key)
+        if style is None:
+            style = self._compute_text_style(ctx, role)
+            ctx.layout.text_styles[key] = style
+        return style
+
+    def _compute_text_style(self, ctx, role):
         styles = [ctx.text_styles["default"]]
         for obj in ctx.stack:
             if isinstance(obj, Frame):
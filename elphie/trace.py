@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+import time
+
+
+class Span:
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def set(self, name, value):
+        self.args[name] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.add_event(self.name, self.category,
+                              self.start, end, self.args)
+
+
+class NullSpan:
+
+    # Returned when tracing is disabled
+
+    def set(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+
+    # Records spans of the build (Chrome trace "complete" events)
+    # and counters; all methods are thread safe
+
+    def __init__(self):
+        self.enabled = False
+        self.origin = None
+        self.lock = threading.Lock()
+        self.events = []
+        self.counters = {}
+
+    def enable(self, origin=None):
+        # Workers in other processes get the origin of the main tracer,
+        # perf_counter() is the same clock in all of them
+        self.enabled = True
+        self.origin = origin if origin is not None else time.perf_counter()
+        self.events = []
+        self.counters = {}
+
+    def disable(self):
+        self.enabled = False
+
+    def span(self, name, category, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, args)
+
+    def add_event(self, name, category, start, end, args):
+        event = {"name": name,
+                 "cat": category,
+                 "ph": "X",
+                 "ts": (start - self.origin) * 1e6,
+                 "dur": (end - start) * 1e6,
+                 "pid": os.getpid(),
+                 "tid": threading.get_ident(),
+                 "args": args}
+        with self.lock:
+            self.events.append(event)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def take_events(self):
+        with self.lock:
+            events = self.events
+            self.events = []
+        return events
+
+    def add_events(self, events):
+        with self.lock:
+            self.events.extend(events)
+
+    def get_summary(self, slide_names=None):
+        with self.lock:
+            events = sorted(self.events, key=lambda e: e["ts"])
+            counters = dict(self.counters)
+
+        wall_time = max((e["ts"] + e["dur"] for e in events), default=0)
+        categories = {}
+        slides = {}
+        for event in events:
+            duration = event["dur"] / 1e6
+            category = categories.setdefault(
+                event["cat"], {"count": 0, "total": 0.0, "max": 0.0})
+            category["count"] += 1
+            category["total"] += duration
+            category["max"] = max(category["max"], duration)
+            if event["cat"] == "step":
+                # A step may have more spans (building and conversion
+                # run in different processes)
+                index = event["args"]["slide"]
+                slide = slides.setdefault(
+                    index, {"slide": index, "steps": set(), "time": 0.0})
+                slide["steps"].add(event["args"]["step"])
+                slide["time"] += duration
+        for index, slide in slides.items():
+            slide["steps"] = len(slide["steps"])
+            if slide_names:
+                slide["title"] = slide_names[index]
+
+        return {
+            "wall_time": wall_time / 1e6,
+            "phases": [{"name": e["name"], "time": e["dur"] / 1e6}
+                       for e in events if e["cat"] == "phase"],
+            "categories": categories,
+            "slides": sorted(slides.values(),
+                             key=lambda s: s["time"], reverse=True),
+            "counters": counters,
+        }
+
+    def format_summary(self, summary, slide_count=5):
+        lines = ["Build time: {:.3f}s".format(summary["wall_time"])]
+        for phase in summary["phases"]:
+            lines.append("  {:<28}{:9.3f}s".format(phase["name"],
+                                                   phase["time"]))
+        for name, category in sorted(summary["categories"].items()):
+            if name == "phase":
+                continue
+            lines.append("  {:<28}{:9.3f}s in {} (max {:.3f}s)".format(
+                name, category["total"], category["count"],
+                category["max"]))
+        if summary["slides"]:
+            lines.append("Slowest slides:")
+        for slide in summary["slides"][:slide_count]:
+            lines.append("  {:<28}{:9.3f}s in {} step(s)".format(
+                "#{} {}".format(slide["slide"] + 1,
+                                slide.get("title") or ""),
+                slide["time"], slide["steps"]))
+        for name, value in sorted(summary["counters"].items()):
+            lines.append("  {}: {}".format(name, value))
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, filename):
+        # The format is read by chrome://tracing and Perfetto
+        with self.lock:
+            events = list(self.events)
+            counters = dict(self.counters)
+        pids = sorted(set(e["pid"] for e in events))
+        metadata = [{"name": "process_name",
+                     "ph": "M",
+                     "pid": pid,
+                     "tid": 0,
+                     "args": {"name": "elphie" if pid == os.getpid()
+                              else "elphie worker {}".format(pid)}}
+                    for pid in pids]
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": metadata + events,
+                       "displayTimeUnit": "ms",
+                       "otherData": {"counters": counters}}, f)
+
+    def write_summary(self, filename, summary):
+        with open(filename, "w") as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+
+tracer = Tracer()
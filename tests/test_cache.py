@@ -0,0 +1,296 @@
+import utils  # noqa
+
+from elphie.cache import QueryCache, CacheBackend, DirectoryBackend, \
+    SQLiteBackend, CacheManifest, GarbagePolicy, BLOB_CHUNK_SIZE, \
+    COMPACT_MIN_RECORDS, parse_size
+
+import os
+import pytest
+import time
+
+
+def test_query_cache_append():
+    filename = utils.output_name("queries-append")
+    cache = QueryCache(filename)
+    assert cache.get("a") is None
+    cache.put_many([("a", (1, 2)), ("b", (3, 4))])
+    cache.put_many([("c", (5, 6))])
+    cache.close()
+
+    cache = QueryCache(filename)
+    assert len(cache) == 3
+    assert cache.get("a") == (1, 2)
+    assert cache.get("c") == (5, 6)
+    cache.put_many([("d", (7, 8))])
+    cache.close()
+    assert QueryCache(filename).get("d") == (7, 8)
+
+
+def test_query_cache_truncated_record():
+    filename = utils.output_name("queries-truncated")
+    cache = QueryCache(filename)
+    cache.put_many([("a", 1)])
+    cache.put_many([("b", 2)])
+    cache.close()
+    with open(filename, "r+b") as f:
+        f.truncate(os.path.getsize(filename) - 3)
+
+    cache = QueryCache(filename)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    cache.put_many([("c", 3)])
+    cache.close()
+
+    cache = QueryCache(filename)
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_query_cache_invalid_file():
+    filename = utils.output_name("queries-invalid")
+    with open(filename, "wb") as f:
+        f.write(b"old pickle data")
+    cache = QueryCache(filename)
+    assert len(cache) == 0
+    cache.put_many([("a", 1)])
+    cache.close()
+    assert QueryCache(filename).get("a") == 1
+
+
+def test_query_cache_compaction():
+    filename = utils.output_name("queries-compaction")
+    cache = QueryCache(filename)
+    cache.put_many([(i, i) for i in range(COMPACT_MIN_RECORDS)])
+    live = set(range(10))
+    assert cache.needs_compaction(live)
+    assert not cache.needs_compaction(set(range(COMPACT_MIN_RECORDS)))
+    size = os.path.getsize(filename)
+    cache.compact(live)
+    cache.put_many([("x", 1)])
+    cache.close()
+    assert os.path.getsize(filename) < size
+
+    cache = QueryCache(filename)
+    assert len(cache) == 11
+    assert cache.get(5) == 5
+    assert cache.get(100) is None
+
+
+def test_query_cache_shared_file():
+    filename = utils.output_name("queries-shared")
+    cache1 = QueryCache(filename)
+    cache2 = QueryCache(filename)
+    cache1.put_many([("a", 1)])
+    cache2.put_many([("b", 2)])
+    cache1.put_many([("c", 3)])
+    assert cache1.get("b") == 2
+    assert QueryCache(filename).items() == [("a", 1), ("b", 2), ("c", 3)]
+
+    # Compaction keeps records that were written by the other cache
+    cache2.compact()
+    cache1.put_many([("d", 4)])
+    cache2.put_many([("e", 5)])
+    cache1.close()
+    cache2.close()
+    assert dict(QueryCache(filename).items()) == \
+        {"a": 1, "b": 2, "c": 3, "d": 4, "e": 5}
+
+
+def check_backend_garbage_collection(backend_class, path):
+    os.makedirs(path)
+    backend = backend_class(path)
+    for name in ("a.pdf", "b.pdf", "c.pdf"):
+        filename = os.path.join(path, name + ".tmp")
+        with open(filename, "wb") as f:
+            f.write(name.encode())
+        backend.write_blob(name, filename)
+    assert backend.has_blob("a.pdf")
+    assert not backend.has_blob("x.pdf")
+    assert backend.read_blob("b.pdf") == b"b.pdf"
+    with open(os.path.join(path, "d.pdf.123-4.tmp"), "wb"):
+        pass
+
+    backend.record_build("deck1.pdf", ["a.pdf", "b.pdf", "a.pdf"])
+    backend.record_build("deck2.pdf", ["b.pdf"])
+    manifest = backend.get_manifest()
+    assert manifest.get_referenced_blobs() == set(["a.pdf", "b.pdf"])
+    assert manifest.blobs["a.pdf"][0] == 5
+    assert [g[0] for g in manifest.decks[os.path.abspath("deck1.pdf")]] \
+        == [1]
+
+    # Another build is running
+    other = backend_class(path)
+    other.lock_build()
+    assert backend.collect_garbage() is None
+    other.unlock_build()
+    other.close()
+
+    assert backend.collect_garbage() == ["c.pdf"]
+    assert not backend.has_blob("c.pdf")
+    assert not os.path.exists(os.path.join(path, "d.pdf.123-4.tmp"))
+    backend.record_build("deck1.pdf", ["a.pdf"])
+    assert backend.collect_garbage() == []
+    assert backend.has_blob("a.pdf") and backend.has_blob("b.pdf")
+
+    # Older generations are dropped from the manifest
+    backend.record_build("deck2.pdf", ["a.pdf"])
+    assert backend.collect_garbage(GarbagePolicy(generations=2)) == []
+    manifest = backend.get_manifest()
+    assert [g[0] for g in manifest.decks[os.path.abspath("deck1.pdf")]] \
+        == [2]
+    assert [g[0] for g in manifest.decks[os.path.abspath("deck2.pdf")]] \
+        == [1, 2]
+    assert backend.collect_garbage() == ["b.pdf"]
+    assert "Unreferenced: 0 blob(s)" in backend.get_manifest().get_report()
+    backend.close()
+
+
+def test_directory_backend_garbage_collection():
+    check_backend_garbage_collection(
+        DirectoryBackend, utils.output_name("directory-backend"))
+
+
+def test_sqlite_backend_garbage_collection():
+    check_backend_garbage_collection(
+        SQLiteBackend, utils.output_name("sqlite-backend"))
+
+
+def check_backend_store_compaction(backend_class, path):
+    os.makedirs(path)
+    backend = backend_class(path)
+    store = backend.open_store("queries")
+    store.put_many((i, i) for i in range(COMPACT_MIN_RECORDS + 20))
+    store.close()
+    backend.record_build("deck1.pdf", [], {"queries": range(10)})
+    backend.record_build("deck2.pdf", [], {"queries": range(10, 20)})
+    backend.record_build("deck1.pdf", [], {"queries": range(5)})
+    assert backend.collect_garbage(GarbagePolicy(generations=2),
+                                   stores=("queries",)) == []
+    store = backend.open_store("queries")
+    assert set(key for key, value in store.items()
+               if not isinstance(key, tuple)) == set(range(20))
+    store.put_many((i, i) for i in range(100, COMPACT_MIN_RECORDS + 100))
+    store.close()
+
+    assert backend.collect_garbage(stores=("queries",)) == []
+    store = backend.open_store("queries")
+    assert dict(store.items()) == dict(
+        [(i, i) for i in range(5)] + [(i, i) for i in range(10, 20)] +
+        [(("build", os.path.abspath("deck1.pdf"), 2), list(range(5))),
+         (("build", os.path.abspath("deck2.pdf"), 1), list(range(10, 20)))])
+    store.close()
+    backend.close()
+
+
+def test_directory_backend_store_compaction():
+    check_backend_store_compaction(
+        DirectoryBackend, utils.output_name("directory-compaction"))
+
+
+def test_sqlite_backend_store_compaction():
+    check_backend_store_compaction(
+        SQLiteBackend, utils.output_name("sqlite-compaction"))
+
+
+def test_sqlite_store():
+    path = utils.output_name("sqlite-store")
+    os.makedirs(path)
+    backend = SQLiteBackend(path)
+    store = backend.open_store("queries")
+    other_store = backend.open_store("fingerprints")
+    assert store.get(b"a") is None
+    store.put_many([(b"a", (1, 2)), (("x", 1), 3)])
+    store.put_many([(b"a", (5, 6))])
+    other_store.put_many([(b"a", "other")])
+    assert store.get(b"a") == (5, 6)
+    assert store.get(("x", 1)) == 3
+    assert len(store) == 2
+    assert not store.needs_compaction()
+    backend.close()
+
+    backend = SQLiteBackend(path)
+    store = backend.open_store("queries")
+    assert sorted(store.items(), key=repr) == [(("x", 1), 3), (b"a", (5, 6))]
+    store.put_many([(i, i) for i in range(COMPACT_MIN_RECORDS)])
+    live = set(range(10))
+    assert store.needs_compaction(live)
+    store.compact(live)
+    assert len(store) == 10
+    assert store.get(5) == 5
+    assert backend.open_store("fingerprints").get(b"a") == "other"
+    backend.close()
+
+
+def test_garbage_policy():
+    now = 1000.0
+    manifest = CacheManifest(
+        {"a": (10, 900.0), "b": (20, 500.0), "c": (30, 950.0),
+         "d": (40, 100.0), "e": (50, 990.0)},
+        {"deck1": [(1, 100.0, ["a", "d"]), (2, 900.0, ["a", "b"])],
+         "deck2": [(3, 990.0, ["c", "e"])]})
+
+    retained, removed = GarbagePolicy().select(manifest, now)
+    assert retained == {"deck1": set([2]), "deck2": set([3])}
+    assert removed == ["d"]
+
+    retained, removed = GarbagePolicy(generations=2).select(manifest, now)
+    assert retained["deck1"] == set([1, 2])
+    assert removed == []
+
+    # Too old builds and blobs
+    retained, removed = GarbagePolicy(generations=2, max_age=200) \
+        .select(manifest, now)
+    assert retained == {"deck1": set([2]), "deck2": set([3])}
+    assert removed == ["b", "d"]
+
+    # Least recently used first, pages of last builds at the end
+    policy = GarbagePolicy(generations=2, max_size=110)
+    assert policy.select(manifest, now)[1] == ["d"]
+    policy = GarbagePolicy(generations=2, max_size=90)
+    assert policy.select(manifest, now)[1] == ["b", "d"]
+    policy = GarbagePolicy(generations=2, max_size=0)
+    assert policy.select(manifest, now)[1] == ["a", "b", "c", "d", "e"]
+
+
+def test_cache_report():
+    now = time.time()
+    manifest = CacheManifest(
+        {"a": (1024, now), "b": (2048, now), "c": (100, now)},
+        {"deck1": [(1, now, ["a", "b"])], "deck2": [(1, now, ["b"])]})
+    report = manifest.get_report()
+    assert "Cache: 3 blobs, 3.1K" in report
+    assert "deck1: 1 generation(s)" in report
+    assert "latest 3.0K in 2 blob(s), all 3.0K, only this deck 1.0K" \
+        in report
+    assert "Unreferenced: 1 blob(s), 100B" in report
+
+
+def test_parse_size():
+    assert parse_size("123") == 123
+    assert parse_size("2k") == 2048
+    assert parse_size("1.5M") == 1572864
+    assert parse_size("1G") == 1 << 30
+
+
+def test_incomplete_backend():
+    class Backend(CacheBackend):
+        def has_blob(self, name):
+            return False
+
+    with pytest.raises(TypeError):
+        Backend(utils.output_name("incomplete-backend"))
+
+
+def test_sqlite_large_blob():
+    path = utils.output_name("sqlite-large-blob")
+    os.makedirs(path)
+    backend = SQLiteBackend(path)
+    data = bytes(range(256)) * (BLOB_CHUNK_SIZE // 100)
+    filename = os.path.join(path, "a.pdf.tmp")
+    with open(filename, "wb") as f:
+        f.write(data)
+    backend.write_blob("a.pdf", filename)
+    assert not os.path.exists(filename)
+    assert backend.read_blob("a.pdf") == data
+    assert backend.get_manifest().blobs["a.pdf"][0] == len(data)
+    backend.close()
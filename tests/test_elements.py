@@ -0,0 +1,40 @@
+import utils  # noqa
+
+from elphie.elements import Image
+
+import lxml.etree as et
+
+SVG = """<svg xmlns="http://www.w3.org/2000/svg"
+ xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+ width="100" height="50">
+ <g inkscape:label="A **2">a<rect width="1" height="1"/>
+  <g inkscape:label="B **3-4"><!-- comment -->b</g>tail-b
+ </g>tail-a
+ <g inkscape:label="C **1-2">c</g>
+ <g inkscape:label="Plain">d</g>
+</svg>"""
+
+
+def visible_labels(data):
+    root = et.fromstring(data)
+    return [element.get(
+        "{http://www.inkscape.org/namespaces/inkscape}label")
+        for element in root.iter("{http://www.w3.org/2000/svg}g")]
+
+
+def test_image_variants():
+    filename = utils.output_name("variants.svg")
+    with open(filename, "w") as f:
+        f.write(SVG)
+    image = Image(filename, None, 2)
+    assert image.get_max_step() == 5
+
+    assert visible_labels(image.get_data(2)) == ["C **1-2", "Plain"]
+    data = image.get_data(3)
+    assert visible_labels(data) == ["A **2", "C **1-2", "Plain"]
+    assert "tail-a" in data and "tail-b" not in data
+    assert visible_labels(image.get_data(5)) == \
+        ["A **2", "B **3-4", "Plain"]
+    assert "<!-- comment -->b</g>tail-b" in image.get_data(5)
+    assert visible_labels(image.get_data(6)) == ["A **2", "Plain"]
+    assert image.get_data(5) is image.get_data(5)
@@ -0,0 +1,41 @@
+import utils  # noqa
+
+from elphie.fingerprint import make_fingerprint, get_class_code_fingerprint
+from elphie.theme import Theme
+
+import pytest
+
+
+def make_theme_class(body):
+    namespace = {"Theme": Theme, "__name__": "deck"}
+    exec("class MyTheme(Theme):\n"
+         "    def render_slide(self, ctx):\n"
+         "        " + body + "\n", namespace)
+    return namespace["MyTheme"]
+
+
+def test_fingerprint_sets():
+    assert make_fingerprint({"a", "b", "c"}) == \
+        make_fingerprint(set(["c", "b", "a"]))
+    assert make_fingerprint(frozenset([1, 2])) == make_fingerprint({1, 2})
+    assert make_fingerprint({1, 2}) != make_fingerprint([1, 2])
+    assert make_fingerprint({1, 2}) != make_fingerprint({1, 3})
+
+
+def test_fingerprint_unsupported_value():
+    class Slotted:
+        __slots__ = ("x",)
+
+    with pytest.raises(Exception, match="'.*Slotted' cannot be"):
+        make_fingerprint(Slotted())
+
+
+def test_fingerprint_class_code():
+    assert get_class_code_fingerprint(Theme) == ""
+    theme1 = make_theme_class("return 1")()
+    theme2 = make_theme_class("return 2")()
+    theme3 = make_theme_class("return 1")()
+    assert type(theme1).__qualname__ == type(theme2).__qualname__
+    assert make_fingerprint(theme1) != make_fingerprint(theme2)
+    assert make_fingerprint(theme1) == make_fingerprint(theme3)
+    assert make_fingerprint(theme1) != make_fingerprint(Theme())
@@ -0,0 +1,134 @@
+import utils  # noqa
+
+from elphie.fontmetrics import FontMetrics, FontMetricsEngine
+from elphie import fontmetrics
+from elphie.textparser import parse_text
+from elphie.textstyle import TextStyle
+
+import os
+import pytest
+
+FONT_DIR = "/usr/share/fonts/truetype/dejavu"
+
+pytestmark = pytest.mark.skipif(
+    not os.path.isfile(os.path.join(FONT_DIR, "DejaVuSans.ttf")),
+    reason="DejaVu fonts are not installed")
+
+
+def make_style(**kwargs):
+    style = TextStyle(font="DejaVu Sans", size=30, line_spacing=1.2,
+                      align="left")
+    for key, value in kwargs.items():
+        setattr(style, key, value)
+    return style
+
+
+def test_font_metrics_width():
+    metrics = FontMetrics((FONT_DIR,))
+    style = make_style()
+    w1 = metrics.get_text_width(parse_text("Hello"), style, {})
+    w2 = metrics.get_text_width(parse_text("Hello Hello"), style, {})
+    assert 50 < w1 < 100
+    assert w2 > 2 * w1
+
+    w3 = metrics.get_text_width(parse_text("Hello\nHello Hello"), style, {})
+    assert w3 == w2
+
+    w4 = metrics.get_text_width(parse_text("Hello"), make_style(size=60), {})
+    assert abs(w4 - 2 * w1) < 0.001
+
+    bold = metrics.get_text_width(
+        parse_text("Hello"), make_style(bold=True), {})
+    assert bold > w1
+
+
+def test_font_metrics_nested_styles():
+    metrics = FontMetrics((FONT_DIR,))
+    style = make_style()
+    styles = {"big": TextStyle(size=60), "b": TextStyle(bold=True)}
+    plain = metrics.get_text_width(parse_text("AB"), style, styles)
+    big = metrics.get_text_width(parse_text("~big{A}B"), style, styles)
+    nested = metrics.get_text_width(
+        parse_text("~big{~b{A}}B"), style, styles)
+    assert plain < big < nested
+
+
+def test_font_metrics_missing_font():
+    metrics = FontMetrics((FONT_DIR,))
+    style = make_style(font="No Such Font")
+    assert metrics.get_text_width(parse_text("Hello"), style, {}) is None
+
+
+class Query:
+
+    def __init__(self, text, style):
+        self.text = parse_text(text)
+        self.style = style
+        self.styles = {}
+
+    def get_height(self):
+        return 10
+
+
+class FixedEngine:
+
+    def __init__(self, width):
+        self.width = width
+        self.computed = 0
+
+    def compute(self, queries):
+        self.computed += len(queries)
+        return [(self.width, 10)] * len(queries)
+
+
+def test_font_metrics_engine():
+    metrics = FontMetrics((FONT_DIR,))
+    fallback = FixedEngine(80)
+    engine = FontMetricsEngine(fallback, font_metrics=metrics)
+    queries = [Query("Hello", make_style()),
+               Query("Hello", make_style(font="No Such Font"))]
+    results = engine.compute(queries)
+    assert results[0][0] != 80
+    assert results[1] == (80, 10)
+    assert fallback.computed == 1
+
+    engine = FontMetricsEngine(
+        fallback, verify=True, tolerance=0.01, font_metrics=metrics)
+    assert engine.compute(queries) == [(80, 10), (80, 10)]
+    assert len(engine.mismatches) == 1
+
+
+def test_font_index_reads_only_header(monkeypatch):
+    filename = os.path.join(FONT_DIR, "DejaVuSans-Bold.ttf")
+    sizes = []
+
+    class CountingFile:
+
+        def __init__(self, f):
+            self.f = f
+
+        def read(self, size=-1):
+            data = self.f.read(size)
+            sizes.append(len(data))
+            return data
+
+        def __getattr__(self, name):
+            return getattr(self.f, name)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.f.close()
+
+    monkeypatch.setattr(fontmetrics, "open",
+                        lambda *args: CountingFile(open(*args)),
+                        raising=False)
+    font = fontmetrics.Font(filename)
+    assert font.family == "DejaVu Sans"
+    assert font.bold and not font.italic
+    assert font.data is None
+    assert sum(sizes) < os.path.getsize(filename) / 10
+
+    font._load_metrics()
+    assert font.advances and font.data is None
@@ -0,0 +1,56 @@
+import utils  # noqa
+
+from elphie.cache import QueryCache
+from elphie.imagestore import ImageStore
+
+import os
+
+SVG = """<svg xmlns="http://www.w3.org/2000/svg"
+ xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+ width="{}" height="50"><g inkscape:label="A **2-3">a</g></svg>"""
+
+
+def write_svg(filename, width, mtime):
+    with open(filename, "w") as f:
+        f.write(SVG.format(width))
+    os.utime(filename, (mtime, mtime))
+
+
+def test_image_store_shares_data():
+    filename = utils.output_name("store.svg")
+    write_svg(filename, 100, 1000)
+    store = ImageStore()
+    data = store.get(filename)
+    assert store.get(os.path.relpath(filename)) is data
+    assert (data.width, data.height, data.max_step) == (100, 50, 3)
+
+    write_svg(filename, 200, 2000)
+    data2 = store.get(filename)
+    assert data2 is not data
+    assert data2.width == 200
+
+
+def test_image_store_metadata():
+    filename = utils.output_name("store-metadata.svg")
+    metadata_filename = utils.output_name("image-metadata")
+    write_svg(filename, 100, 1000)
+
+    store = ImageStore()
+    store.open_metadata(QueryCache(metadata_filename))
+    assert store.get(filename).labels == [(2, 3)]
+    store.close_metadata()
+
+    store = ImageStore()
+    store.open_metadata(QueryCache(metadata_filename))
+    data = store.get(filename)
+    assert (data.width, data.labels, data.max_step) == (100, [(2, 3)], 3)
+    assert data._root is None
+    assert "a</g>" in data.get_variant(2)
+    assert "a</g>" not in data.get_variant(4)
+    store.close_metadata()
+
+    write_svg(filename, 300, 2000)
+    store = ImageStore()
+    store.open_metadata(QueryCache(metadata_filename))
+    assert store.get(filename).width == 300
+    store.close_metadata()
@@ -0,0 +1,101 @@
+import utils  # noqa
+
+from elphie.inkscape import InkscapePool, InkscapeError
+
+import os
+import pytest
+import stat
+import sys
+
+
+# Behaves like 'inkscape --shell'; a source containing 'crash' terminates
+# the shell, 'crash-once' only when the marker file does not exist yet
+# and 'hang' makes it stop responding
+FAKE_SHELL = """#!{python}
+import os
+import sys
+import time
+
+marker = {marker!r}
+sys.stdout.write("Inkscape interactive shell mode\\n>")
+sys.stdout.flush()
+for line in sys.stdin:
+    if line.strip() == "quit":
+        break
+    source, option, target = line.split()
+    with open(source, "rb") as f:
+        data = f.read()
+    if data == b"crash" or (data == b"crash-once" and
+                            not os.path.exists(marker)):
+        open(marker, "w").close()
+        sys.exit(1)
+    if data == b"hang":
+        time.sleep(60)
+    with open(target, "wb") as f:
+        f.write(data)
+    sys.stdout.write("\\n>")
+    sys.stdout.flush()
+"""
+
+
+def make_fake_shell(name):
+    filename = utils.output_name(name + ".py")
+    with open(filename, "w") as f:
+        f.write(FAKE_SHELL.format(python=sys.executable,
+                                  marker=utils.output_name(name + ".marker")))
+    os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR)
+    return filename
+
+
+def convert(pool, data, name):
+    target = utils.output_name(name)
+    pool.convert(data, target)
+    with open(target, "rb") as f:
+        return f.read()
+
+
+def test_inkscape_pool_convert():
+    pool = InkscapePool(2, make_fake_shell("fake-inkscape"))
+    try:
+        assert convert(pool, b"page1", "pool1.pdf") == b"page1"
+        assert convert(pool, b"page2", "pool2.pdf") == b"page2"
+        # An idle worker is reused
+        assert len(pool.workers) == 1
+    finally:
+        pool.close()
+    assert not os.path.exists(pool.tmp_dir)
+
+
+def test_inkscape_pool_crashed_worker():
+    pool = InkscapePool(1, make_fake_shell("fake-inkscape-crash"))
+    try:
+        with pytest.raises(InkscapeError):
+            convert(pool, b"crash", "crash.pdf")
+        assert pool.workers == []
+        assert convert(pool, b"page", "after-crash.pdf") == b"page"
+    finally:
+        pool.close()
+
+
+def test_inkscape_pool_restart():
+    pool = InkscapePool(1, make_fake_shell("fake-inkscape-restart"))
+    try:
+        assert convert(pool, b"page", "before-restart.pdf") == b"page"
+        pid = pool.workers[0].process.pid
+        # The first worker terminates, the conversion is repeated
+        assert convert(pool, b"crash-once", "restart.pdf") == b"crash-once"
+        assert len(pool.workers) == 1
+        assert pool.workers[0].process.pid != pid
+    finally:
+        pool.close()
+
+
+def test_inkscape_pool_timeout():
+    pool = InkscapePool(1, make_fake_shell("fake-inkscape-hang"), timeout=0.5)
+    try:
+        with pytest.raises(InkscapeError, match="does not respond"):
+            convert(pool, b"hang", "hang.pdf")
+        assert pool.workers == []
+        assert convert(pool, b"page", "after-hang.pdf") == b"page"
+    finally:
+        pool.close()
@@ -0,0 +1,152 @@
+import utils  # noqa
+
+from elphie.pdfmerge import PdfReader, PdfMerger
+
+import struct
+import zlib
+
+
+def write_pdf(filename, objects, root=1):
+    # objects: {number: bytes}; written with a classic xref table
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = len(data)
+        data += b"%d 0 obj\n" % number + objects[number] + b"\nendobj\n"
+    xref = len(data)
+    size = max(objects) + 1
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % size
+    for number in range(1, size):
+        data += b"%010d 00000 n \n" % offsets[number]
+    data += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" \
+        % (size, root, xref)
+    with open(filename, "wb") as f:
+        f.write(data)
+
+
+def write_compressed_pdf(filename, objects, stream_objects):
+    # Objects in stream_objects are stored in an object stream and
+    # the cross-reference table is a PNG-predicted xref stream
+    data = bytearray(b"%PDF-1.5\n")
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = len(data)
+        data += b"%d 0 obj\n" % number + objects[number] + b"\nendobj\n"
+
+    objstm_number = max(list(objects) + list(stream_objects)) + 1
+    header = []
+    body = bytearray()
+    for number in sorted(stream_objects):
+        header.append(b"%d %d" % (number, len(body)))
+        body += stream_objects[number] + b" "
+    header = b" ".join(header) + b" "
+    content = zlib.compress(header + body)
+    offsets[objstm_number] = len(data)
+    data += b"%d 0 obj\n<< /Type /ObjStm /N %d /First %d /Length %d " \
+        b"/Filter /FlateDecode >>\nstream\n" % (
+            objstm_number, len(stream_objects), len(header), len(content))
+    data += content + b"\nendstream\nendobj\n"
+
+    xref_number = objstm_number + 1
+    offsets[xref_number] = len(data)
+    rows = [(0, 0, 0)]
+    for number in range(1, xref_number + 1):
+        if number in stream_objects:
+            rows.append((2, objstm_number,
+                         sorted(stream_objects).index(number)))
+        else:
+            rows.append((1, offsets[number], 0))
+    raw = bytearray()
+    previous = bytes(6)
+    for row in rows:
+        line = struct.pack(">BIB", *row)
+        raw += b"\x02" + bytes((a - b) & 0xff
+                               for a, b in zip(line, previous))
+        previous = line
+    content = zlib.compress(bytes(raw))
+    data += b"%d 0 obj\n<< /Type /XRef /Size %d /W [1 4 1] /Root 1 0 R " \
+        b"/Filter /FlateDecode /DecodeParms << /Predictor 12 /Columns 6 >> " \
+        b"/Length %d >>\nstream\n" % (xref_number, xref_number + 1,
+                                      len(content))
+    data += content + b"\nendstream\nendobj\n"
+    data += b"startxref\n%d\n%%%%EOF\n" % offsets[xref_number]
+    with open(filename, "wb") as f:
+        f.write(data)
+
+
+def page_objects(text):
+    content = b"BT /F1 12 Tf (" + text + b") Tj ET"
+    return {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        2: b"<< /Type /Pages /Kids [3 0 R] /Count 1 "
+           b"/MediaBox [0 0 100 100] >>",
+        3: b"<< /Type /Page /Parent 2 0 R /Contents 4 0 R "
+           b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        4: b"<< /Length %d >>\nstream\n" % len(content) + content +
+           b"\nendstream",
+        5: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    }
+
+
+def get_page_texts(filename):
+    reader = PdfReader(filename)
+    pages, nodes = reader.get_pages()
+    texts = []
+    for number, page in pages:
+        assert reader.resolve(page[b"MediaBox"])
+        font = reader.resolve(page[b"Resources"][b"Font"][b"F1"])
+        assert font[b"BaseFont"] == b"Helvetica"
+        value, stream = reader.get_object(page[b"Contents"].number)
+        texts.append(stream)
+    return texts
+
+
+def merge_pdfs(filenames, output):
+    merger = PdfMerger(output)
+    for filename in filenames:
+        merger.append(filename)
+    merger.close()
+
+
+def test_merge_pdfs():
+    filenames = []
+    for i in range(3):
+        filename = utils.output_name("page{}.pdf".format(i))
+        write_pdf(filename, page_objects(b"Page %d" % i))
+        filenames.append(filename)
+
+    compressed = page_objects(b"Compressed")
+    stream_objects = dict((n, compressed.pop(n)) for n in (1, 2, 3, 5))
+    filename = utils.output_name("compressed.pdf")
+    write_compressed_pdf(filename, compressed, stream_objects)
+    filenames.append(filename)
+
+    output = utils.output_name("merged.pdf")
+    merge_pdfs(filenames, output)
+    texts = get_page_texts(output)
+    assert texts == [b"BT /F1 12 Tf (Page 0) Tj ET",
+                     b"BT /F1 12 Tf (Page 1) Tj ET",
+                     b"BT /F1 12 Tf (Page 2) Tj ET",
+                     b"BT /F1 12 Tf (Compressed) Tj ET"]
+
+
+def test_merge_pdfs_shared_objects():
+    objects = page_objects(b"First")
+    objects[2] = b"<< /Type /Pages /Kids [3 0 R 6 0 R] /Count 2 " \
+                 b"/MediaBox [0 0 100 100] >>"
+    objects[6] = b"<< /Type /Page /Parent 2 0 R /Contents 4 0 R " \
+                 b"/Resources << /Font << /F1 5 0 R >> >> >>"
+    filename = utils.output_name("two-pages.pdf")
+    write_pdf(filename, objects)
+
+    output = utils.output_name("merged2.pdf")
+    merge_pdfs([filename, filename], output)
+    reader = PdfReader(output)
+    pages, nodes = reader.get_pages()
+    assert len(pages) == 4
+    # Both pages of one input share the font object
+    fonts = [page[b"Resources"][b"Font"][b"F1"].number
+             for number, page in pages]
+    assert fonts[0] == fonts[1]
+    assert fonts[1] != fonts[2]
+    assert fonts[2] == fonts[3]
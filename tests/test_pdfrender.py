@@ -0,0 +1,110 @@
+import utils  # noqa
+
+from elphie.pdfrender import RendererPDF, parse_color, write_pdf, \
+    draw_document, COLORS
+from elphie.textparser import parse_text
+from elphie.textstyle import TextStyle
+from elphie.utils import Rect
+
+import json
+import pytest
+
+
+def test_parse_color():
+    assert parse_color("white") == (1.0, 1.0, 1.0)
+    assert parse_color("#ff0000") == (1.0, 0.0, 0.0)
+    assert parse_color("#00F") == (0.0, 0.0, 1.0)
+    assert parse_color("CornflowerBlue") == \
+        (100 / 255.0, 149 / 255.0, 237 / 255.0)
+    assert parse_color("rgb(255, 0, 100%)") == (1.0, 0.0, 1.0)
+    assert len(COLORS) == 147
+    for color in ("notacolor", "#12345", "rgb(1, 2)", "#ggg"):
+        with pytest.raises(Exception) as info:
+            parse_color(color)
+        assert str(info.value) == "Invalid color: '{}'".format(color)
+
+
+def make_page():
+    r = RendererPDF()
+    r.begin(300, 200)
+    r.draw_rect(Rect(0, 0, 300, 200), "white")
+    r.draw_rect(Rect(20, 20, 100, 50), "white", "#000055", 5, rx=10, ry=5)
+    style = TextStyle(font="Ubuntu", size=20, line_spacing=1.2,
+                      align="center", color="#222")
+    styles = {"emph": TextStyle(italic=True, color="orange")}
+    r.draw_text(150, 100, parse_text("Hello ~emph{world}\n!"), style, styles)
+    r.end()
+    return r
+
+
+def test_pdf_renderer_ops():
+    r = make_page()
+    document = json.loads(r.to_string())
+    assert document["width"] == 300
+    assert [op[0] for op in document["ops"]] == ["rect", "rect", "text"]
+    text = document["ops"][2]
+    assert text[4]["color"] == "#222"
+    assert text[5] == {"emph": {"italic": True, "color": "orange"}}
+    assert r.to_string() == make_page().to_string()
+
+
+def test_pdf_renderer_write():
+    pytest.importorskip("cairo")
+    filename = utils.output_name("page.pdf")
+    write_pdf(make_page().to_string(), filename, None)
+    with open(filename, "rb") as f:
+        assert f.read(5) == b"%PDF-"
+
+
+class FakeCairo:
+
+    FONT_SLANT_NORMAL = "normal"
+    FONT_SLANT_ITALIC = "italic"
+    FONT_WEIGHT_NORMAL = "normal"
+    FONT_WEIGHT_BOLD = "bold"
+
+
+class FakeContext:
+
+    # Records calls; each character is 10 units wide
+
+    def __init__(self):
+        self.calls = []
+
+    def text_extents(self, text):
+        return (0, 0, 0, 0, len(text) * 10.0, 0)
+
+    def __getattr__(self, name):
+        def method(*args):
+            self.calls.append((name,) + args)
+        return method
+
+
+def test_draw_document():
+    r = make_page()
+    r.draw_image("<svg/>", 10, 20, 0.5)
+    images = []
+
+    def draw_image(ctx, svg):
+        images.append(svg)
+        ctx.paint()
+
+    ctx = FakeContext()
+    draw_document(ctx, FakeCairo, json.loads(r.to_string()), draw_image)
+    calls = ctx.calls
+    assert calls[0] == ("scale", 0.75, 0.75)
+    assert ("rectangle", 0, 0, 300, 200) in calls
+    assert ("set_source_rgb", 0.0, 0.0, 85 / 255.0) in calls
+
+    # "Hello " and "world" centered around x = 150
+    shown = [(c[1], calls[i - 1]) for i, c in enumerate(calls)
+             if c[0] == "show_text"]
+    assert [text for text, move in shown] == ["Hello ", "world", "!"]
+    assert shown[0][1] == ("move_to", 95.0, 100)
+    assert shown[1][1] == ("move_to", 155.0, 100)
+    assert shown[2][1] == ("move_to", 145.0, 124.0)
+    assert ("select_font_face", "Ubuntu", "italic", "normal") in calls
+
+    assert images == ["<svg/>"]
+    assert calls[-5:] == [("save",), ("translate", 10, 20),
+                          ("scale", 0.5, 0.5), ("paint",), ("restore",)]
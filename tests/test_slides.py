@@ -1,6 +1,21 @@
 import utils  # noqa
 
-from elphie.slides import Slides
+from elphie.slides import Slides, SlideBuilder, Context, _map_bounded
+from elphie.svg import RendererSVG
+from elphie.cache import DirectoryBackend
+from elphie.theme import BlueTheme
+from elphie.pdfmerge import PdfReader
+from elphie import slides as slides_module
+from test_pdfmerge import write_pdf, page_objects
+
+import itertools
+import multiprocessing
+import os
+import pickle
+import pytest
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 def test_slide_render():
@@ -62,3 +77,379 @@ def test_slide_render():
     cc.column().text("Hello\nfrom the\n~emph{second}\ncolumn")
 
     slides.render()
+
+
+def test_query_jobs():
+    slides = Slides(utils.output_name("slides.pdf"),
+                    cache_dir=utils.output_name("cache"),
+                    parse_args=False)
+    queries = dict((i, None) for i in range(10))
+
+    jobs = slides._make_query_jobs(queries, 4)
+    assert [len(job) for job in jobs] == [1] * 10
+
+    slides.query_batch_size = 100
+    jobs = slides._make_query_jobs(queries, 4)
+    assert [len(job) for job in jobs] == [3, 3, 3, 1]
+
+    slides.query_batch_size = 2
+    jobs = slides._make_query_jobs(queries, 4)
+    assert [len(job) for job in jobs] == [2] * 5
+    assert sum(jobs, []) == list(queries.items())
+
+
+def make_test_slides():
+    slides = Slides(utils.output_name("slides.pdf"),
+                    cache_dir=utils.output_name("cache"),
+                    parse_args=False)
+
+    slide = slides.new_slide("Text")
+    slide.h1("This is nice text slide!")
+    slide.text("This is ~emph{testing} slide!\n!!!", show=(2, 3))
+    slide.text("Last text", show=4)
+
+    slide = slides.new_slide("Image")
+    slide.image(os.path.join(utils.TEST_ROOT, "testdata.svg"), scale=0.4)
+
+    slide = slides.new_slide("Frame")
+    frame = slide.frame("This is FRAME!")
+    frame.text("My text1")
+    lst = frame.list()
+    lst.item().text("Red")
+    lst.item(show=2).text("Green")
+
+    slide = slides.new_slide("Code")
+    code = slide.code("if x == 0:\n    print('Hello world')", "python")
+    code.line_emphasis(2, show=2)
+
+    slide = slides.new_slide("Columns")
+    columns = slide.columns()
+    columns.column().text("Left")
+    columns.column().text("Right", show=2)
+    return slides
+
+
+def make_test_builder(slides):
+    renderer = RendererSVG()
+    query_cache = {}
+    for slide in slides.slides:
+        ctx = Context(renderer, slide.theme, slide, None, None,
+                      slides.user_defined_text_styles)
+        queries = slide.gather_queries(ctx)
+        slide.query_keys = [key for key, query in queries]
+        for key, query in queries:
+            # Widths differ between texts, so using a result of another
+            # query changes the layout
+            query_cache[key] = (50 + key[0], query.get_height())
+    return SlideBuilder(slides.slides, slides.width, slides.height,
+                        slides.user_defined_text_styles, query_cache)
+
+
+def test_slide_builder_pickle():
+    builder = make_test_builder(make_test_slides())
+    builder2 = pickle.loads(pickle.dumps(builder))
+    for i, slide in enumerate(builder.slides):
+        steps = range(1, slide.get_max_step() + 1)
+        svgs = builder.build_steps(i, steps)
+        assert len(svgs) == slide.get_max_step()
+        assert svgs == builder2.build_steps(i, steps)
+
+    # Results of queries are swapped between texts
+    keys = list(builder2.query_cache)
+    values = [builder2.query_cache[key] for key in keys]
+    builder3 = pickle.loads(pickle.dumps(builder))
+    builder3.query_cache = dict(zip(keys, values[1:] + values[:1]))
+    assert any(builder.build_steps(i, [1]) != builder3.build_steps(i, [1])
+               for i in range(len(builder.slides)))
+
+
+def test_slide_fingerprint():
+    slides = make_test_slides()
+    builder = make_test_builder(slides)
+    fingerprints = [builder.get_fingerprint(slide) for slide in slides.slides]
+    assert len(set(fingerprints)) == len(fingerprints)
+
+    slides2 = make_test_slides()
+    builder2 = make_test_builder(slides2)
+    assert fingerprints == [builder2.get_fingerprint(slide)
+                            for slide in slides2.slides]
+
+    slides2.slides[0].element.text("New text")
+    slides2.slides[1].theme = BlueTheme()
+    slides2.slides[2].element.childs[0].box.childs[0].show = 2
+    code = slides2.slides[3].element.childs[0]
+    code.line_emphasis(1, show=3)
+    builder2 = make_test_builder(slides2)
+    fingerprints2 = [builder2.get_fingerprint(slide)
+                     for slide in slides2.slides]
+    assert [a == b for a, b in zip(fingerprints, fingerprints2)] == \
+        [False, False, False, False, True]
+
+
+def test_size_requests_are_memoized():
+    slides = Slides(utils.output_name("slides.pdf"),
+                    cache_dir=utils.output_name("cache"),
+                    parse_args=False)
+    box = slides.new_slide("Nested")
+    for i in range(8):
+        box.text("Level {}".format(i))
+        box = box.frame("Frame {}".format(i)) if i % 2 else box.box()
+    box.text("Bottom")
+    box.text("Late", show=3)
+
+    builder = make_test_builder(slides)
+    theme = slides.slides[0].theme
+    calls = []
+    get_text_size_request = theme.get_text_size_request
+
+    def counting_get_text_size_request(ctx, text):
+        calls.append(text)
+        return get_text_size_request(ctx, text)
+
+    theme.get_text_size_request = counting_get_text_size_request
+    builder.build(builder.make_context(slides.slides[0], 1))
+    assert len(calls) == 10
+
+    # The layout is shared by all steps of the slide
+    builder.build_steps(0, (2, 3))
+    assert len(calls) == 10
+
+
+def test_step_states():
+    slides = make_test_slides()
+    slide = slides.new_slide("Delayed image")
+    slide.image(os.path.join(utils.TEST_ROOT, "testdata.svg"), show=3)
+    slide.text("End", show=(9, 9))
+
+    builder = make_test_builder(slides)
+    for i, slide in enumerate(slides.slides):
+        states = slide.get_step_states()
+        svgs = builder.build_steps(i, range(1, len(states) + 1))
+        for a, b in itertools.combinations(range(len(states)), 2):
+            assert (states[a] == states[b]) == (svgs[a] == svgs[b])
+
+    states = slides.slides[-1].get_step_states()
+    assert len(states) == 9
+    assert len(set(states)) == 8
+    assert states[0] == states[1]
+
+
+def test_invariant_fragments():
+    slides = make_test_slides()
+    slide = slides.slides[4]
+    left, right = slide.element.childs[0].childs
+    assert slide.get_invariant_elements() == set((left, right.childs[0]))
+    assert slides.slides[1].get_invariant_elements() == set()
+
+    # build_steps() releases layouts, so steps are built one by one
+    builder = make_test_builder(slides)
+    for slide in slides.slides:
+        steps = range(1, slide.get_max_step() + 1)
+        svgs = [builder.build(builder.make_context(slide, step))
+                for step in steps]
+        layout = builder.layouts[slide]
+        fragments = len(layout.fragments)
+        layout.invariant_elements = ()
+        assert svgs == [builder.build(builder.make_context(slide, step))
+                        for step in steps]
+        assert len(layout.fragments) == fragments
+    assert len(builder.layouts[slides.slides[4]].fragments) == 2
+
+
+def test_build_returns_bytes():
+    slides = make_test_slides()
+    builder = make_test_builder(slides)
+    ctx = builder.make_context(slides.slides[0], 1)
+    data = builder.build(ctx)
+    assert data.startswith(b"<svg ")
+    assert ctx.renderer.xml is None
+
+    builder = make_test_builder(slides)
+    builder.renderer = "pdf"
+    ctx = builder.make_context(slides.slides[0], 2)
+    assert builder.build(ctx).startswith(b"{")
+    assert ctx.renderer.ops is None
+
+
+def test_map_bounded():
+    submitted = []
+
+    def items():
+        for i in range(20):
+            submitted.append(i)
+            yield i
+
+    with ThreadPoolExecutor(4) as executor:
+        results = []
+        for result in _map_bounded(executor, lambda x: x * 2, items(), 3):
+            assert len(submitted) - len(results) <= 4
+            results.append(result)
+    assert results == [i * 2 for i in range(20)]
+
+
+def test_make_pdf_single_flight():
+    slides = make_test_slides()
+    os.makedirs(slides.cache_dir, exist_ok=True)
+    conversions = []
+    started = threading.Event()
+
+    def convert_to_pdf(source, target):
+        conversions.append(target)
+        started.set()
+        time.sleep(0.05)
+        with open(target, "wb") as f:
+            f.write(source)
+
+    slides.convert_to_pdf = convert_to_pdf
+    slides.cache = DirectoryBackend(slides.cache_dir)
+    with ThreadPoolExecutor(4) as executor:
+        first = executor.submit(slides.make_pdf, b"page")
+        started.wait()
+        others = [executor.submit(slides.make_pdf, b"page")
+                  for i in range(3)]
+        filenames = [f.result() for f in [first] + others]
+    assert len(set(filenames)) == 1
+    assert len(conversions) == 1
+    assert conversions[0].endswith(".tmp")
+    with open(os.path.join(slides.cache_dir, filenames[0]), "rb") as f:
+        assert f.read() == b"page"
+    assert not [f for f in os.listdir(slides.cache_dir)
+                if f.endswith(".tmp")]
+
+
+class FakeQueryEngine:
+
+    def compute(self, queries):
+        return [(100.0, query.get_height()) for query in queries]
+
+
+def test_failed_render_keeps_deck():
+    slides = make_test_slides()
+    slides.cache_dir = utils.output_name("cache-failed-render")
+    slides.filename = utils.output_name("failed.pdf")
+    with open(slides.filename, "wb") as f:
+        f.write(b"previous deck")
+
+    def convert_to_pdf(source, target):
+        raise Exception("Conversion failed")
+
+    slides._make_query_engine = FakeQueryEngine
+    slides.convert_to_pdf = convert_to_pdf
+    with pytest.raises(Exception, match="Conversion failed"):
+        slides.render()
+    with open(slides.filename, "rb") as f:
+        assert f.read() == b"previous deck"
+    assert not [f for f in os.listdir(utils.OUTPUT_DIR)
+                if f.startswith("failed.pdf.")]
+
+
+def test_failed_render_keeps_queries():
+    slides = make_test_slides()
+    slides.cache_dir = utils.output_name("cache-failed-queries")
+    slides.filename = utils.output_name("failed-queries.pdf")
+    slides.query_batch_size = 1
+
+    def convert_to_pdf(source, target):
+        raise Exception("Conversion failed")
+
+    slides._make_query_engine = FakeQueryEngine
+    slides.convert_to_pdf = convert_to_pdf
+    with pytest.raises(Exception, match="Conversion failed"):
+        slides.render()
+    keys = set(key for slide in slides.slides for key in slide.query_keys)
+    assert len(keys) > 1
+    store = DirectoryBackend(slides.cache_dir).open_store("queries")
+    try:
+        assert set(key for key, value in store.items()) == keys
+    finally:
+        store.close()
+
+
+def test_images_are_blobs(monkeypatch):
+    slides = make_test_slides()
+    slides.cache_dir = utils.output_name("cache-images")
+    os.makedirs(slides.cache_dir)
+    slides.cache = DirectoryBackend(slides.cache_dir)
+    calls = []
+
+    def run_inkscape(args, stdin):
+        calls.append(stdin)
+        with open(args[1], "wb") as f:
+            f.write(b"png " + stdin.encode())
+
+    monkeypatch.setattr(slides_module, "run_inkscape", run_inkscape)
+    for svg in ("<svg/>", "<svg/>", "<svg></svg>"):
+        assert slides._convert_image(svg).read() == b"png " + svg.encode()
+    assert calls == ["<svg/>", "<svg></svg>"]
+    assert len(slides.images) == 2
+
+    slides.cache.record_build("deck.pdf", sorted(slides.images)[:1])
+    manifest = slides.cache.get_manifest()
+    assert set(manifest.blobs) == slides.images
+    assert slides.cache.collect_garbage() == sorted(slides.images)[1:]
+
+
+def test_process_executor_without_fork(monkeypatch):
+    slides = make_test_slides()
+    slides.cache_dir = utils.output_name("cache-without-fork")
+    slides.filename = utils.output_name("without-fork.pdf")
+    slides.executor = "process"
+
+    def convert_to_pdf(source, target):
+        write_pdf(target, page_objects(b"page"))
+
+    monkeypatch.setattr(multiprocessing, "get_all_start_methods",
+                        lambda: ["spawn", "forkserver"])
+    monkeypatch.setattr(slides_module, "ProcessPoolExecutor", None)
+    slides._make_query_engine = FakeQueryEngine
+    slides.convert_to_pdf = convert_to_pdf
+    slides.render()
+    pages, nodes = PdfReader(slides.filename).get_pages()
+    assert len(pages) == sum(s.get_max_step() for s in slides.slides)
+
+
+def test_layouts_are_released(monkeypatch):
+    slides = make_test_slides()
+    slides.cache_dir = utils.output_name("cache-layouts")
+    slides.filename = utils.output_name("layouts.pdf")
+    slides.threads = 1
+    layout_counts = []
+    make_context = SlideBuilder.make_context
+
+    def counting_make_context(builder, slide, step):
+        ctx = make_context(builder, slide, step)
+        layout_counts.append(len(builder.layouts))
+        return ctx
+
+    def convert_to_pdf(source, target):
+        write_pdf(target, page_objects(b"page"))
+
+    monkeypatch.setattr(SlideBuilder, "make_context", counting_make_context)
+    slides._make_query_engine = FakeQueryEngine
+    slides.convert_to_pdf = convert_to_pdf
+    slides.render()
+    # Two jobs per thread are built at once
+    assert max(layout_counts) <= 3
+    assert len(layout_counts) == 13
+
+    builder = make_test_builder(make_test_slides())
+    builder.build_steps(0, [1, 2])
+    assert builder.layouts == {}
+
+
+def test_missing_query(capsys):
+    slides = make_test_slides()
+    builder = make_test_builder(slides)
+    builder.query_cache = {}
+    ctx = builder.make_context(slides.slides[0], 1)
+    with pytest.raises(Exception) as info:
+        builder.build(ctx)
+    assert "'This is nice text slide!'" in str(info.value)
+    assert "was not measured" in str(info.value)
+    assert capsys.readouterr().out == ""
+
+    # Themes may still look up a query by its key only
+    ctx.query_cache = {b"key": (1, 2)}
+    assert ctx.get_query(b"key") == (1, 2)
+    with pytest.raises(Exception, match="was not measured"):
+        ctx.get_query(b"other")
@@ -1,10 +1,12 @@
 import utils  # noqa
 
-from elphie.svg import RendererSVG
+from elphie.svg import RendererSVG, parse_query_all
 from elphie.textstyle import TextStyle
 from elphie.textparser import parse_text
 from elphie.utils import Rect
 
+import pytest
+
 
 def test_svg_text():
     r = RendererSVG()
@@ -59,3 +61,83 @@ def test_svg_rect():
 
     r.end()
     r.write(utils.output_name("rect.svg"))
+
+
+def test_svg_text_size_query_key():
+    r = RendererSVG(query_sources={})
+    style = TextStyle(font="Ubuntu", size=20, line_spacing=1.2)
+    emph = TextStyle(italic=True)
+    text = parse_text("Hello ~emph{world}")
+
+    key = r.get_text_size_query_key(style, {"emph": emph}, text)
+    assert len(key) == 20
+    assert r.query_sources[key] == text
+    assert key == r.get_text_size_query_key(
+        style.copy(), {"emph": emph.copy()}, parse_text("Hello ~emph{world}"))
+
+    bold = TextStyle(bold=True)
+    assert key != r.get_text_size_query_key(style, {"emph": bold}, text)
+    assert key != r.get_text_size_query_key(
+        style, {"emph": emph}, parse_text("Hello world"))
+
+
+def test_svg_text_size_query_key_ignores_colors():
+    r = RendererSVG()
+    style = TextStyle(font="Ubuntu", size=20, line_spacing=1.2, color="red")
+    emph = TextStyle(italic=True, color="orange")
+    text = parse_text("Hello ~emph{world}")
+    key = r.get_text_size_query_key(style, {"emph": emph}, text)
+
+    style2 = style.copy()
+    style2.color = "blue"
+    style2.align = "right"
+    emph2 = emph.copy()
+    emph2.color = "black"
+    assert key == r.get_text_size_query_key(style2, {"emph": emph2}, text)
+
+    key2, query = r.get_text_size_query(style2, {"emph": emph2}, text)
+    assert key2 == key
+    assert query.style.color is None
+    assert query.style.align is None
+    assert query.styles["emph"].color is None
+    assert query.styles["emph"].italic
+
+    style2.size = 21
+    assert key != r.get_text_size_query_key(style2, {"emph": emph}, text)
+
+
+def test_svg_font_size_types():
+    # Cached attributes keep the type of the value, so output does not
+    # depend on which of equal values was rendered first
+    outputs = []
+    for sizes in ((30, 30.0), (30.0, 30)):
+        r = RendererSVG()
+        r.begin(100, 100)
+        for size in sizes:
+            style = TextStyle()
+            style.size = size
+            style.line_spacing = 1.0
+            r.draw_text(0, 0, parse_text("x"), style, {})
+        r.end()
+        outputs.append(r.to_string())
+    assert "font-size='30'" in outputs[0]
+    assert "font-size='30.0'" in outputs[0]
+    assert outputs[0].index("font-size='30'") < \
+        outputs[0].index("font-size='30.0'")
+    assert outputs[1].index("font-size='30.0'") < \
+        outputs[1].index("font-size='30'")
+
+
+QUERY_ALL_OUTPUT = b"""svg1,0,0,300,300
+t0,0,-12.5,45.25,15
+tspan3,0,-12.5,45.25,15
+t1,0,-12.5,102,30.5
+"""
+
+
+def test_parse_query_all():
+    assert parse_query_all(QUERY_ALL_OUTPUT, 2) == [45.25, 102.0]
+    with pytest.raises(Exception, match="'t2'"):
+        parse_query_all(QUERY_ALL_OUTPUT, 3)
+    with pytest.raises(Exception, match="'t0'"):
+        parse_query_all(b"** (inkscape): WARNING **: failed\n", 1)
@@ -44,3 +44,30 @@ def test_element_child_with_text():
          "abc<a>"
          "xyz</a>"
          "123</test>")
+
+
+def test_fragment():
+    xml = Xml()
+    xml.element("test")
+    mark = xml.mark()
+    xml.element("a")
+    xml.set("x", 1)
+    xml.text("abc")
+    xml.close()
+    assert xml.join_since(mark) == "<a x='1'>abc</a>"
+    xml.raw_text("<b />")
+    xml.close()
+    assert xml.to_string() == "<test><a x='1'>abc</a><b /></test>"
+
+
+def test_attribute_escaping():
+    xml = Xml()
+    xml.element("test")
+    xml.set("a", "x<'&'>")
+    xml.set("b", 1.5)
+    xml.set("c", True)
+    xml.text("a <b>")
+    xml.close()
+    assert xml.to_string() == \
+        ("<test a='x&lt;\\'&amp;\\'&gt;' b='1.5' c='True'>"
+         "a&#160;&lt;b&gt;</test>")
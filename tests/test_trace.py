@@ -0,0 +1,68 @@
+import utils  # noqa
+
+from elphie.trace import Tracer
+
+import json
+
+
+def test_disabled_tracer():
+    tracer = Tracer()
+    with tracer.span("a", "phase") as span:
+        span.set("x", 1)
+    tracer.count("hits")
+    assert tracer.events == []
+    assert tracer.counters == {}
+
+
+def test_tracer_summary():
+    tracer = Tracer()
+    tracer.enable()
+    with tracer.span("Building", "phase"):
+        for slide, step in ((0, 1), (0, 2), (1, 1)):
+            with tracer.span("step", "step", slide=slide, step=step):
+                with tracer.span("render", "render") as span:
+                    span.set("bytes", 10)
+    # A step of the first slide converted in another thread
+    with tracer.span("step", "step", slide=0, step=2):
+        pass
+    tracer.count("hits")
+    tracer.count("hits", 2)
+    try:
+        with tracer.span("failed", "convert"):
+            raise ValueError()
+    except ValueError:
+        pass
+
+    summary = tracer.get_summary(["First", "Second"])
+    assert [phase["name"] for phase in summary["phases"]] == ["Building"]
+    assert summary["categories"]["step"]["count"] == 4
+    assert summary["categories"]["render"]["count"] == 3
+    assert summary["counters"] == {"hits": 3}
+    assert summary["wall_time"] >= summary["phases"][0]["time"]
+    slides = dict((s["title"], s["steps"]) for s in summary["slides"])
+    assert slides == {"First": 2, "Second": 1}
+    assert [e["args"] for e in tracer.events if e["name"] == "failed"] \
+        == [{"error": "ValueError"}]
+    assert "Slowest slides:" in tracer.format_summary(summary)
+
+
+def test_chrome_trace():
+    tracer = Tracer()
+    tracer.enable()
+    with tracer.span("a", "phase"):
+        pass
+    worker = Tracer()
+    worker.enable(tracer.origin)
+    with worker.span("b", "step", slide=0, step=1):
+        pass
+    tracer.add_events(worker.take_events())
+    assert worker.events == []
+
+    filename = utils.output_name("trace.json")
+    tracer.write_chrome_trace(filename)
+    with open(filename) as f:
+        events = json.load(f)["traceEvents"]
+    assert events[0]["ph"] == "M"
+    assert [(e["name"], e["ph"]) for e in events[1:]] == \
+        [("a", "X"), ("b", "X")]
+    assert all(e["ts"] >= 0 and e["dur"] >= 0 for e in events[1:])